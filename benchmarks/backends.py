@@ -0,0 +1,116 @@
+"""
+Ingest and query benchmark of the processing db backends.
+
+The eventlist tables are created under benchmark names in the database of each config, e.g. a MySQL
+server on localhost, and with --sqlite in a temporary sqlite database with the tuned pragmas.
+Synthetic runs are inserted with insert_events in one transaction per night.
+Then the noise db query of EventIndex and single run lookups are timed, and the tables are dropped.
+
+    python benchmarks/backends.py --sqlite mysql.yaml
+"""
+import time
+from itertools import groupby
+
+import click
+import numpy as np
+
+from eventlist.model import Event, RunEvents, processing_db
+from eventlist.bulk import insert_events
+from eventlist.index import EventIndex
+
+from synthetic import synthetic_runs, database_configs, connect, drop_table, timed
+
+BENCHMARK_TABLES = {Event: 'EventList_benchmark', RunEvents: 'EventListRuns_benchmark'}
+
+
+def ingest(runs, mode, storage):
+    """
+    Inserts the (night, runId, eventlist) runs with one transaction per night, returns the inserted runs
+    """
+    inserted = []
+    for night, nightRuns in groupby(runs, key=lambda run: run[0]):
+        with processing_db.atomic():
+            for night, runId, df in nightRuns:
+                insert_events(df, mode=mode, storage=storage)
+                inserted.append((night, runId))
+    return inserted
+
+
+def noise_events(index, runs):
+    """
+    The query of the noise db: the pedestal and ext1 events of the runs
+    """
+    index.clear()
+    return len(index.events_for_runs(runs, event_types=[1, 1024]))
+
+
+def single_runs(index, runs):
+    """
+    All events of the runs, fetched one run after the other like interactive lookups
+    """
+    index.clear()
+    return sum(len(index.events_for_run(night, runId)) for night, runId in runs)
+
+
+@click.command()
+@click.argument('configs', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--sqlite', is_flag=True, help='Also run the benchmark on a temporary sqlite database')
+@click.option('--nights', default=50, help='Nights of the synthetic table')
+@click.option('--runs', default=20, help='Runs per night')
+@click.option('--events', default=1000, help='Events per run')
+@click.option('--mode', default='insert', type=click.Choice(['insert', 'load_data']),
+    help='Insert mode of the MySQL databases, sqlite always uses multi row inserts')
+@click.option('--storage', default='rows', type=click.Choice(['rows', 'packed']), help='Storage of the events')
+@click.option('--query_runs', default=200, help='Runs of the noise db query')
+@click.option('--lookup_runs', default=50, help='Runs fetched one by one')
+@click.option('--repeat', default=3, help='Runs of each query, the fastest one is reported')
+def main(configs, sqlite, nights, runs, events, mode, storage, query_runs, lookup_runs, repeat):
+    """
+    Times inserting and querying synthetic events in the databases of the CONFIGS,
+    the processing_database section of each config is used
+    """
+    databases = database_configs(configs, sqlite)
+    if not databases:
+        raise click.UsageError("Give at least one config or --sqlite")
+
+    rng = np.random.RandomState(1)
+    tables = {model: model._meta.db_table for model in BENCHMARK_TABLES}
+    results = []
+    for name, dbconfig in databases:
+        connect(dbconfig)
+        dbMode = 'insert' if dbconfig.get('backend', 'mysql') == 'sqlite' else mode
+        try:
+            for model, table in BENCHMARK_TABLES.items():
+                model._meta.db_table = table
+                drop_table(table)
+                model.create_table()
+
+            start = time.perf_counter()
+            runList = ingest(synthetic_runs(nights, runs, events), dbMode, storage)
+            ingestTime = time.perf_counter() - start
+            results.append((name, 'ingest ({}, {})'.format(dbMode, storage), nights*runs*events, ingestTime))
+
+            index = EventIndex(storage=storage)
+            queryRuns = [runList[i] for i in sorted(rng.choice(len(runList), min(query_runs, len(runList)), replace=False))]
+            lookupRuns = [runList[i] for i in rng.choice(len(runList), min(lookup_runs, len(runList)), replace=False)]
+            queries = [
+                ('noise events of {} runs'.format(len(queryRuns)), noise_events, queryRuns),
+                ('{} single runs'.format(len(lookupRuns)), single_runs, lookupRuns),
+            ]
+            for query, function, queryArgs in queries:
+                rows, duration = timed(function, index, queryArgs, repeat=repeat)
+                results.append((name, query, rows, duration))
+        finally:
+            for model, table in BENCHMARK_TABLES.items():
+                drop_table(table)
+                model._meta.db_table = tables[model]
+            processing_db.close()
+
+    print()
+    print("{:<30} {:<30} {:>9} {:>10} {:>12}".format('database', 'step', 'events', 'time [s]', 'events/s'))
+    for name, step, rows, duration in results:
+        print("{:<30} {:<30} {:>9} {:>10.4f} {:>12.0f}".format(name, step, rows, duration, rows/max(duration, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Benchmark of the eventlist schema migrated by el_migrate_index against the former one.
+
+Both schemas are created as separate tables in the database of each config and filled with the same
+synthetic events. The former one has signed columns, an id column and the unique (night, runId, eventNr)
+index. The migrated one has the compact unsigned columns, the primary key (night, runId, eventNr), the
+(eventType, night, runId) index and, on MySQL, the partitions by night. Then the queries the eventlist
+mostly serves are timed on both tables, and the tables are dropped.
+
+    python benchmarks/eventlist_indexes.py --sqlite mysql.yaml
+"""
+import time
+
+import click
+import numpy as np
+import peewee as pew
+
+from eventlist.model import Event, processing_db, is_sqlite
+from eventlist.bulk import EVENT_COLUMNS, insert_rows
+from eventlist.migrations import create_table_sql, create_index_sql
+from eventlist.utils import night_run_condition
+
+from synthetic import synthetic_runs, database_configs, connect, drop_table, timed
+
+BEFORE_TABLE = 'EventList_benchmark_before'
+AFTER_TABLE = 'EventList_benchmark_after'
+
+
+class FormerEvent(pew.Model):
+    """
+    The eventlist model before el_migrate_index
+    """
+    night = pew.IntegerField()
+    runId = pew.SmallIntegerField()
+    eventNr = pew.IntegerField()
+    UTC = pew.IntegerField()
+    UTCus = pew.IntegerField()
+    eventType = pew.SmallIntegerField()
+    runType = pew.SmallIntegerField()
+
+    class Meta:
+        database = processing_db
+        db_table = BEFORE_TABLE
+        indexes = (
+            (('night', 'runId', 'eventNr'), True),
+        )
+
+
+def create_tables():
+    """
+    Creates the table of the former schema and the one of the migrated schema
+    """
+    FormerEvent.create_table()
+    if is_sqlite():
+        Event.create_table()
+    else:
+        processing_db.execute_sql(create_table_sql(AFTER_TABLE, time.gmtime().tm_year + 1))
+        for sql in create_index_sql(AFTER_TABLE):
+            processing_db.execute_sql(sql)
+
+
+def noise_events(model, runs):
+    """
+    The query of the noise db: the pedestal and ext1 events of the runs, as EventIndex queries them
+    """
+    query = (model.select(model.night, model.runId, model.eventNr, model.UTC)
+        .where(night_run_condition(model.night, model.runId, runs, model.eventType << [1, 1024]))
+        .tuples())
+    return len(list(query))
+
+
+def pedestal_events(model, firstnight, lastnight):
+    """
+    The pedestal events of a range of nights
+    """
+    query = (model.select(model.night, model.runId, model.eventNr)
+        .where(model.eventType == 1024)
+        .where((model.night >= firstnight) & (model.night <= lastnight))
+        .tuples())
+    return len(list(query))
+
+
+def night_events(model, night):
+    """
+    All events of one night
+    """
+    return len(list(model.select().where(model.night == night).tuples()))
+
+
+@click.command()
+@click.argument('configs', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--sqlite', is_flag=True, help='Also run the benchmark on a temporary sqlite database')
+@click.option('--nights', default=200, help='Nights of the synthetic table')
+@click.option('--runs', default=20, help='Runs per night')
+@click.option('--events', default=1000, help='Events per run')
+@click.option('--query_runs', default=200, help='Runs of the noise db query')
+@click.option('--query_nights', default=100, help='Nights of the pedestal query')
+@click.option('--repeat', default=3, help='Runs of each query, the fastest one is reported')
+def main(configs, sqlite, nights, runs, events, query_runs, query_nights, repeat):
+    """
+    Times the eventlist queries on the former and the migrated schema in the databases of the CONFIGS,
+    the processing_database section of each config is used
+    """
+    databases = database_configs(configs, sqlite)
+    if not databases:
+        raise click.UsageError("Give at least one config or --sqlite")
+
+    rng = np.random.RandomState(1)
+    eventTable = Event._meta.db_table
+    results = []
+    for name, dbconfig in databases:
+        connect(dbconfig)
+        Event._meta.db_table = AFTER_TABLE
+        try:
+            drop_table(BEFORE_TABLE)
+            drop_table(AFTER_TABLE)
+            create_tables()
+
+            start = time.perf_counter()
+            allRuns = []
+            for night, runId, df in synthetic_runs(nights, runs, events):
+                with processing_db.atomic():
+                    insert_rows(BEFORE_TABLE, EVENT_COLUMNS, df)
+                    insert_rows(AFTER_TABLE, EVENT_COLUMNS, df)
+                allRuns.append((night, runId))
+            print("{}: filled both tables with {} events in {:.1f} s".format(
+                name, nights*runs*events, time.perf_counter() - start))
+
+            queryRuns = [allRuns[i] for i in sorted(rng.choice(len(allRuns), min(query_runs, len(allRuns)), replace=False))]
+            firstnight = allRuns[len(allRuns)//4][0]
+            lastnight = allRuns[min(len(allRuns)//4 + query_nights*runs, len(allRuns)) - 1][0]
+            queries = [
+                ('noise events of {} runs'.format(len(queryRuns)), noise_events, (queryRuns,)),
+                ('pedestal events of {} nights'.format(query_nights), pedestal_events, (firstnight, lastnight)),
+                ('all events of one night', night_events, (firstnight,)),
+            ]
+            for query, function, args in queries:
+                before, beforeTime = timed(function, FormerEvent, *args, repeat=repeat)
+                after, afterTime = timed(function, Event, *args, repeat=repeat)
+                if before != after:
+                    raise click.ClickException("The tables returned different results for: " + query)
+                results.append((name, query, before, beforeTime, afterTime))
+        finally:
+            drop_table(BEFORE_TABLE)
+            drop_table(AFTER_TABLE)
+            Event._meta.db_table = eventTable
+            processing_db.close()
+
+    print()
+    print("{:<30} {:<30} {:>9} {:>11} {:>11}".format('database', 'query', 'events', 'before [s]', 'after [s]'))
+    for name, query, rows, beforeTime, afterTime in results:
+        print("{:<30} {:<30} {:>9} {:>11.4f} {:>11.4f}".format(name, query, rows, beforeTime, afterTime))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark of the eventlist creation from .fits.gz files: the per event loop the index
+generation used before against the column read of eventlist.data.processFitsFile.
+
+A synthetic run with the header and the columns of a FACT data file is written first,
+--roi adds the pixel data so the file size gets close to a real run.
+
+    python benchmarks/fits_reader.py --events 20000 --roi 10
+"""
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from eventlist.data import RunType, processFitsFile
+
+NUM_PIXELS = 1440
+
+
+def write_run(path, numEvents, roi):
+    """
+    Writes a synthetic FACT run with numEvents events and roi samples per pixel
+    """
+    events = np.arange(numEvents)
+    columns = [
+        fits.Column('EventNum', 'J', bzero=2**31, array=(events + 1).astype(np.uint32)),
+        fits.Column('TriggerType', 'I', array=np.where(events % 10 == 0, 1024, 4).astype(np.int16)),
+        fits.Column('UnixTimeUTC', '2J', array=np.stack(
+            [1500000000 + events // 80, (events * 12500) % 1000000], axis=1).astype(np.int32)),
+    ]
+    if roi > 0:
+        columns.append(fits.Column('Data', '{}I'.format(NUM_PIXELS * roi),
+            array=np.zeros((numEvents, NUM_PIXELS * roi), dtype=np.int16)))
+    table = fits.BinTableHDU.from_columns(columns)
+    table.header['RUNTYPE'] = 'data'
+    table.header['NIGHT'] = 20170101
+    table.header['RUNID'] = 42
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(path, overwrite=True)
+
+
+def perEventLoop(file):
+    """
+    The former processFitsFile, reading the columns event by event
+    """
+    hdu = fits.open(file)
+    table = hdu[1]
+    header = table.header
+    runType = str(header['RUNTYPE']).strip()
+    night = header['NIGHT']
+    runId = header['RUNID']
+
+    data = []
+    for i in range(header['NAXIS2']):
+        eventNr = table.data['EventNum'][i]
+        utc = table.data['UnixTimeUTC'][i]
+        eventType = table.data['TriggerType'][i]
+        data.append([night, runId, eventNr, utc[0], utc[1], eventType, RunType[runType].value])
+    hdu.close()
+    return pd.DataFrame(data, columns=["night", "runId", "eventNr", "UTC", "UTCus", "eventType", "runType"])
+
+
+def best_of(repeat, function, *args):
+    """
+    Returns the result and the shortest duration of repeat calls
+    """
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        durations.append(time.perf_counter() - start)
+    return result, min(durations)
+
+
+@click.command()
+@click.option('--events', default=20000, help='Events of the synthetic run, a 5 min data run has about 20000')
+@click.option('--roi', default=0, help='Samples per pixel of the pixel data column, 0 for no pixel data')
+@click.option('--repeat', default=3, help='Runs of each reader, the fastest one is reported')
+def main(events, roi, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, '20170101_042.fits.gz')
+        write_run(path, events, roi)
+        print("Run with {} events, {:.1f} MB".format(events, os.path.getsize(path) / 1e6))
+
+        old, oldTime = best_of(repeat, perEventLoop, path)
+        new, newTime = best_of(repeat, processFitsFile, path)
+
+    if not (old.astype(np.int64).values == new.astype(np.int64).values).all():
+        raise click.ClickException("The readers returned different eventlists")
+    print("per event loop: {:.3f} s".format(oldTime))
+    print("column read:    {:.3f} s".format(newTime))
+    print("speedup:        {:.1f}x".format(oldTime / newTime))
+
+
+if __name__ == '__main__':
+    main()
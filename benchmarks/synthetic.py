@@ -0,0 +1,81 @@
+"""
+Synthetic eventlists and database helpers shared by the benchmarks
+"""
+import atexit
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from eventlist.data import create_eventlist
+from eventlist.model import processing_db, init_processing_db
+from eventlist.bulk import quote
+from eventlist.utils import load_config
+
+# trigger types of the synthetic events and their fractions: physics, pedestal, external light pulser, ext1
+TRIGGER_TYPES = [4, 1024, 260, 1]
+TRIGGER_FRACTIONS = [0.9, 0.05, 0.04, 0.01]
+
+
+def synthetic_runs(num_nights, runs_per_night, events_per_run, firstnight=20170101, seed=0):
+    """
+    Yields (night, runId, eventlist) of runs with events every 12.5 ms and a random trigger type mix
+    """
+    rng = np.random.RandomState(seed)
+    start = datetime.strptime(str(firstnight), '%Y%m%d')
+    for i in range(num_nights):
+        date = start + timedelta(days=i)
+        night = int(date.strftime('%Y%m%d'))
+        # the runs start at 20:00 UTC, one every 5 minutes
+        evening = int((date - datetime(1970, 1, 1)).total_seconds()) + 20*3600
+        for runId in range(1, runs_per_night + 1):
+            micros = (evening + runId*300) * 1000000 + np.arange(events_per_run) * 12500
+            utc = np.stack([micros // 1000000, micros % 1000000], axis=1)
+            eventType = rng.choice(TRIGGER_TYPES, size=events_per_run, p=TRIGGER_FRACTIONS)
+            yield night, runId, create_eventlist(night, runId, 'data', np.arange(1, events_per_run + 1), utc, eventType)
+
+
+def database_configs(configs, sqlite):
+    """
+    Returns (name, processing_database section) of the given config files and, with sqlite,
+    of a sqlite database in a temporary directory
+    """
+    databases = []
+    for path in configs:
+        config, configpath = load_config(path)
+        dbconfig = config['processing_database']
+        databases.append(('{} ({})'.format(dbconfig.get('backend', 'mysql'), os.path.basename(path)), dbconfig))
+    if sqlite:
+        directory = tempfile.mkdtemp(prefix='eventlist_benchmark_')
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        databases.append(('sqlite (temporary)', {'backend': 'sqlite', 'database': os.path.join(directory, 'eventlist.sqlite')}))
+    return databases
+
+
+def connect(dbconfig):
+    """
+    Sets up and connects the processing db of the config
+    """
+    if processing_db.obj is not None and not processing_db.is_closed():
+        processing_db.close()
+    init_processing_db(dbconfig)
+    processing_db.connect()
+
+
+def drop_table(table):
+    processing_db.execute_sql("DROP TABLE IF EXISTS {}".format(quote(table)))
+
+
+def timed(function, *args, repeat=1):
+    """
+    Returns the result and the shortest duration of repeat calls
+    """
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        durations.append(time.perf_counter() - start)
+    return result, min(durations)
@@ -0,0 +1,94 @@
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+import peewee as pew
+
+from .model import Event, processing_db, is_sqlite, max_rows_per_statement
+from .packed import insert_packed_runs
+
+log = logging.getLogger(__name__)
+
+EVENT_COLUMNS = ['night', 'runId', 'eventNr', 'UTC', 'UTCus', 'eventType', 'runType']
+
+
+def quote(name):
+    """
+    Quotes a table or column name for the processing db
+    """
+    return '{0}{1}{0}'.format(processing_db.quote_char, name)
+
+
+def column_values(df, columns, start=0, stop=None):
+    """
+    Returns the rows start to stop of the integer columns as one 2d array
+    """
+    return np.column_stack([df[c].values[start:stop].astype(np.int64) for c in columns])
+
+
+def insert_rows(table, columns, df, batch_size=10000):
+    """
+    Inserts the columns of the dataframe with multi row inserts of batch_size rows each
+    """
+    head = "INSERT INTO {} ({}) VALUES ".format(quote(table), ', '.join(quote(c) for c in columns))
+    row = '(' + ', '.join([processing_db.interpolation]*len(columns)) + ')'
+    batch_size = max_rows_per_statement(batch_size, len(columns))
+
+    for start in range(0, len(df), batch_size):
+        values = column_values(df, columns, start, start+batch_size)
+        sql = head + ', '.join([row]*len(values))
+        processing_db.execute_sql(sql, values.ravel().tolist())
+
+
+def load_rows(table, columns, df, batch_size=1000000):
+    """
+    Loads the columns of the dataframe with LOAD DATA LOCAL INFILE from a temporary file,
+    the connection needs to be opened with local_infile enabled.
+    With LOCAL, MySQL skips duplicate keys and clamps out of range values with a warning only,
+    so an error is raised unless every row of a file was loaded without warnings, as the multi row inserts would fail
+    """
+    sql = "LOAD DATA LOCAL INFILE {} INTO TABLE {} FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({})".format(
+        processing_db.interpolation, quote(table), ', '.join(quote(c) for c in columns))
+
+    for start in range(0, len(df), batch_size):
+        values = column_values(df, columns, start, start+batch_size)
+        with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False) as f:
+            np.savetxt(f, values, fmt='%d', delimiter='\t')
+        try:
+            cursor = processing_db.execute_sql(sql, [f.name])
+        finally:
+            os.remove(f.name)
+        # clamped values are loaded, but counted as warnings
+        warnings = getattr(cursor, 'warning_count', 0)
+        if cursor.rowcount != len(values) or warnings:
+            messages = [row[2] for row in processing_db.execute_sql("SHOW WARNINGS LIMIT 5").fetchall()]
+            raise pew.IntegrityError("Loaded {} of {} rows into {} with {} warnings: {}".format(
+                cursor.rowcount, len(values), table, warnings, '; '.join(messages)))
+
+
+def insert_events(df, batch_size=10000, mode='insert', storage='rows'):
+    """
+    Bulk inserts the events of the dataframe into the eventlist table
+
+    @batch_size the rows per insert statement or per loaded file
+    @mode either 'insert' for multi row inserts or 'load_data' for LOAD DATA LOCAL INFILE
+    @storage 'rows' for one row per event or 'packed' for one RunEvents row per run
+    """
+    start = time.monotonic()
+    table = Event._meta.db_table
+    if storage == 'packed':
+        insert_packed_runs(df)
+    elif storage != 'rows':
+        raise ValueError("Unknown storage: '{}'".format(storage))
+    elif mode == 'insert':
+        insert_rows(table, EVENT_COLUMNS, df, batch_size)
+    elif mode == 'load_data':
+        if is_sqlite():
+            raise ValueError("The insert mode 'load_data' needs the mysql backend")
+        load_rows(table, EVENT_COLUMNS, df, batch_size)
+    else:
+        raise ValueError("Unknown insert mode: '{}'".format(mode))
+
+    duration = time.monotonic() - start
+    log.info("Inserted {} events in {:.2f} s, {:.0f} rows/s".format(len(df), duration, len(df)/max(duration, 1e-6)))
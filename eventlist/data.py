@@ -1,5 +1,6 @@
 import logging
 import os
+import numpy as np
 import pandas as pd
 from enum import Enum
 
@@ -13,67 +14,213 @@ class RunType(Enum):
 
 from astropy.io import fits
 
+# compact types of the eventlist columns, the trigger types go up to 33792 so they need an unsigned type
+EVENTLIST_DTYPES = [
+    ("night", np.int32),
+    ("runId", np.int16),
+    ("eventNr", np.uint32),
+    ("UTC", np.uint32),
+    ("UTCus", np.uint32),
+    ("eventType", np.uint16),
+    ("runType", np.int16),
+]
+EVENTLIST_COLUMNS = [name for name, dtype in EVENTLIST_DTYPES]
+EVENT_DTYPE = np.dtype(EVENTLIST_DTYPES)
 
-def processFitsFile(file):
+
+def native(column):
     """
-    Creates an eventlist from a fits File
+    Returns the column as an array in native byte order, fits columns are big endian
+    """
+    column = np.asarray(column)
+    return column.astype(column.dtype.newbyteorder('='), copy=True)
+
+
+def create_eventlist(night, runId, runType, eventNr, utc, eventType):
+    """
+    Creates the eventlist dataframe of a run directly from the column arrays of its events,
+    the columns get the compact types of EVENTLIST_DTYPES
+    """
+    numEvents = len(eventNr)
+    columns = {
+        'night': night,
+        'runId': runId,
+        'eventNr': eventNr,
+        'UTC': utc[:, 0],
+        'UTCus': utc[:, 1],
+        'eventType': eventType,
+        'runType': RunType[runType].value,
+    }
+    return pd.DataFrame({
+        name: np.broadcast_to(columns[name], numEvents).astype(dtype)
+        for name, dtype in EVENTLIST_DTYPES
+    }, columns=EVENTLIST_COLUMNS)
+
+
+def getDataRunType(file, header):
+    """
+    Returns the run type of the file or None if it is not a data file
     """
-    hdu = fits.open(file)
-    table = hdu[1]
-    header = table.header
-    
     runType = str(header['RUNTYPE']).strip()
     if not runType in ["data","pedestal"]: # only process data files
         log.error("File: '"+ file + "' is not a data file skipping, runType: '"+str(runType)+"'")
-        return
+        return None
+    return runType
 
-    night = header['NIGHT']
-    runId = header['RUNID']
 
-    numEvents = header['NAXIS2']
-    data = []
-    for i in range(numEvents):
-        if i%100==0:
-            log.debug("  "+str(i)+"/"+str(numEvents))
-        eventNr = table.data['EventNum'][i]
-        utc = table.data['UnixTimeUTC'][i]
-        eventType = table.data['TriggerType'][i]
-        
-        
-        tmp = [night, runId, eventNr, utc[0], utc[1], eventType, RunType[runType].value]
-        data.append(tmp)
-    return pd.DataFrame(data, columns=["night", "runId", "eventNr","UTC", "UTCus", "eventType", "runType"])
+def processFitsFile(file):
+    """
+    Creates an eventlist from a fits File
+
+    The needed columns are read at once as arrays, uncompressed files are memory mapped
+    so only the bytes of these columns are touched.
+    """
+    with fits.open(file, memmap=True) as hdu:
+        table = hdu[1]
+        header = table.header
+
+        runType = getDataRunType(file, header)
+        if runType is None:
+            return
+
+        night = header['NIGHT']
+        runId = header['RUNID']
+
+        log.debug("  Reading columns of {} events".format(header['NAXIS2']))
+        # copy the columns out of the memory map before the file is closed
+        eventNr = native(table.data['EventNum'])
+        utc = native(table.data['UnixTimeUTC'])
+        eventType = native(table.data['TriggerType'])
+
+    return create_eventlist(night, runId, runType, eventNr, utc, eventType)
+
+
+# byte sizes and numpy types of the fits column formats, zfits tiles are stored little endian
+ZFITS_FORMATS = {'L': 'u1', 'B': 'u1', 'A': 'S1', 'I': '<i2', 'J': '<i4', 'K': '<i8', 'E': '<f4', 'D': '<f8'}
+ZFITS_BLOCK_HEADER_SIZE = 10
+ZFITS_RAW = 0
+
+
+def read_zfits_columns(file, columns):
+    """
+    Reads the given columns of a FACT zfits file without decompressing any other column
+
+    Only the catalog and the blocks of the requested columns are read from the heap,
+    which works as long as these blocks are stored raw. That is the case for everything
+    besides the pixel data, otherwise a ValueError is raised.
+    Returns the header of the table and a dict with the columns.
+    """
+    with fits.open(file, memmap=False) as hdu:
+        table = hdu[1]
+        header = table.header.copy()
+        dataStart = table.fileinfo()['datLoc']
+
+    if header.get('ZSHRINK', 1) != 1:
+        raise ValueError("Shrinked zfits catalogs are not supported")
+
+    numRows = header['ZNAXIS2']
+    numTiles = header['NAXIS2']
+    tileLen = header['ZTILELEN']
+    numCols = header['TFIELDS']
+    names = [header['TTYPE{}'.format(i+1)].strip() for i in range(numCols)]
+
+    data = {}
+    with open(file, 'rb') as f:
+        f.seek(dataStart)
+        catalog = np.fromfile(f, dtype='>i8', count=numTiles*numCols*2).reshape(numTiles, numCols, 2)
+        heapStart = dataStart + header['ZHEAPPTR']
+
+        for name in columns:
+            col = names.index(name)
+            form = header['ZFORM{}'.format(col+1)].strip()
+            repeat = int(form[:-1] or 1)
+            dtype = np.dtype(ZFITS_FORMATS[form[-1]])
+
+            tiles = []
+            for tile in range(numTiles):
+                rows = min(tileLen, numRows - tile*tileLen)
+                size, offset = catalog[tile, col]
+                f.seek(heapStart + offset)
+                block = f.read(size)
+
+                ordering = chr(block[8])
+                numProcs = block[9]
+                processings = np.frombuffer(block, dtype='<u2', count=numProcs, offset=ZFITS_BLOCK_HEADER_SIZE)
+                if list(processings) != [ZFITS_RAW]:
+                    raise ValueError("Column '{}' is not stored raw".format(name))
+
+                payload = block[ZFITS_BLOCK_HEADER_SIZE + 2*numProcs:]
+                if len(payload) != rows*repeat*dtype.itemsize:
+                    raise ValueError("Unexpected block size for column '{}'".format(name))
+
+                values = np.frombuffer(payload, dtype=dtype)
+                if ordering == 'C':
+                    values = values.reshape(repeat, rows).T
+                else:
+                    values = values.reshape(rows, repeat)
+                tiles.append(values)
+
+            values = np.concatenate(tiles).astype(dtype.newbyteorder('='))
+            tzero = header.get('TZERO{}'.format(col+1))
+            if tzero:
+                values = values.astype(np.int64) + int(tzero)
+            data[name] = values[:, 0] if repeat == 1 else values
+
+    return header, data
+
+
+def is_plausible_eventlist(numEvents, eventNr, utc):
+    """
+    Checks the read columns for the right length and a sensible time range,
+    to catch zfits files not following the expected layout
+    """
+    if len(eventNr) != numEvents or len(utc) != numEvents:
+        return False
+    # FACT started operation in 2011
+    return numEvents == 0 or (utc[:, 0].min() > 1293840000 and utc[:, 0].max() < 4294967296)
 
 
 from zfits import FactFits
-def processZFitsFile(file):
+def processZFitsFile(file, columns_only=True):
     """
     Creates an eventlist from a ZFitsFile
+
+    @columns_only Only decompress the needed columns instead of every events pixel data,
+        falls back to reading all events if the file can't be read this way
     """
+    if columns_only:
+        try:
+            header, data = read_zfits_columns(file, ['EventNum', 'UnixTimeUTC', 'TriggerType'])
+            runType = getDataRunType(file, header)
+            if runType is None:
+                return
+            if is_plausible_eventlist(header['ZNAXIS2'], data['EventNum'], data['UnixTimeUTC']):
+                return create_eventlist(header['NIGHT'], header['RUNID'], runType,
+                    data['EventNum'], data['UnixTimeUTC'], data['TriggerType'])
+            log.warning("  Implausible columns in file: '"+file+"', reading all events")
+        except (ValueError, KeyError) as e:
+            log.warning("  Couldn't read only the columns of file: '"+file+"', reading all events: "+str(e))
+
     f = FactFits(file)
     header = f.header()
-    
-    runType = str(header['RUNTYPE']).strip()
-    if not runType in ["data","pedestal"]: # only process data files
-        log.error("  File: '"+ file + "' is not a data file skipping, runType: '"+str(runType)+"'")
-        return
 
-    night = header['NIGHT']
-    runId = header['RUNID']
+    runType = getDataRunType(file, header)
+    if runType is None:
+        return
 
     numEvents = header['ZNAXIS2']
-    data = []
+    eventNr = np.zeros(numEvents, dtype=np.int64)
+    utc = np.zeros((numEvents, 2), dtype=np.int64)
+    eventType = np.zeros(numEvents, dtype=np.int64)
     for i, event in enumerate(f):
         if i%100==0:
             log.debug("  "+str(i)+"/"+str(numEvents))
-        eventNr = event['EventNum']
-        utc = event['UnixTimeUTC']
-        eventType = event['TriggerType']
-        
-        tmp = [night, runId, eventNr, utc[0], utc[1], eventType, RunType[runType].value]
-        data.append(tmp)
-    return pd.DataFrame(data, columns=["night", "runId", "eventNr","UTC", "UTCus", "eventType", "runType"])
-    
+        eventNr[i] = event['EventNum']
+        utc[i] = event['UnixTimeUTC']
+        eventType[i] = event['TriggerType']
+
+    return create_eventlist(header['NIGHT'], header['RUNID'], runType, eventNr, utc, eventType)
+
 
 def process_data_file(filename):
     """
@@ -95,3 +242,30 @@ def process_data_file(filename):
         log.error("Unknown extension: '"+ext+"' of file: '"+filename+"', skipping")
         return None
     return df
+
+
+EVENTLIST_FORMATS = ['csv', 'npy']
+
+
+def save_eventlist(df, path):
+    """
+    Saves the eventlist as csv or, for a .npy path, as binary numpy array with the types of EVENTLIST_DTYPES
+    """
+    if path.endswith('.npy'):
+        data = np.empty(len(df), dtype=EVENTLIST_DTYPES)
+        for name in EVENTLIST_COLUMNS:
+            data[name] = df[name].values
+        np.save(path, data)
+    else:
+        df.to_csv(path, index=False)
+
+
+def load_eventlist(path):
+    """
+    Loads an eventlist saved with save_eventlist, npy files are memory mapped instead of parsed.
+    The columns of the dataframe are views into the memory map, they are only copied when modified
+    """
+    if path.endswith('.npy'):
+        data = np.load(path, mmap_mode='r')
+        return pd.DataFrame({name: data[name] for name in EVENTLIST_COLUMNS}, columns=EVENTLIST_COLUMNS, copy=False)
+    return pd.read_csv(path, index_col=False, dtype=dict(EVENTLIST_DTYPES))
@@ -4,12 +4,15 @@ import subprocess as sp
 import pandas as pd
 from fact.factdb import (RunInfo, RawFileAvailISDCStatus, connect_database)
 
-from .utils import load_config
+from .utils import load_config, read_manifest, write_manifest, load_json_state, save_json_state
 
 import logging
 import time
+from datetime import datetime, timedelta
 
 from eventlist.model import *
+from eventlist.model import max_rows_per_statement
+import peewee as pew
 
 
 logger = logging.getLogger('EventList')
@@ -19,11 +22,12 @@ logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
 
 
-def getAllNewFiles(limit=None):
+def getAllNewFiles(limit=None, since=None):
     """
-    Returns all files that are currently not part of the ProcessingInfo db
+    Returns all files that are currently not part of the ProcessingInfo db, sorted by night and runId
     
     @limit the maximum amount of files to read
+    @since only look at nights after this one
     """
     query = (
         RunInfo.select(
@@ -38,6 +42,8 @@ def getAllNewFiles(limit=None):
         .where((RunInfo.fruntypekey == 2)|(RunInfo.fruntypekey == 1))
         .where(RunInfo.fdrsstep.is_null(True))
     )
+    if since is not None:
+        query = query.where(RunInfo.fnight > since)
     df_isdc = pd.DataFrame(list(query.dicts()), columns=["night", "runId"])
     
     query = (
@@ -46,12 +52,14 @@ def getAllNewFiles(limit=None):
             ProcessingInfo.runId,
         )
     )
+    if since is not None:
+        query = query.where(ProcessingInfo.night > since)
     df_processing = pd.DataFrame(list(query.dicts()), columns=["night","runId"])
     
     
     merged = pd.merge(df_isdc, df_processing, on=['night', 'runId'], how='left', indicator=True)
     merged = merged[merged['_merge'] == 'left_only']
-    merged.drop('_merge', axis=1)
+    merged = merged.drop('_merge', axis=1).sort_values(['night', 'runId'])
     
     if limit:
         merged = merged.head(limit)
@@ -78,76 +86,180 @@ def getAllNotProcessedFiles(filesystem='isdc'):
     df = pd.DataFrame(list(query.dicts()), columns=["night", "runId", "extension"])
     return df
 
-from fact.path import tree_path
+from .rawfolder import listNight
 
-def returnPathIfExists(rawfolder, night, runId):
-    """
-    Creates a full path for the specific run and test wheater it is an fz or gz file and if it exists
-    """
-    path = tree_path(night, runId, rawfolder, ".fits")
-    
-    if os.path.exists(path+".fz"):
-        return path+".fz"
-    if os.path.exists(path+".gz"):
-        return path+".gz"
-    return None
-
-def getAllRunningFiles(jobs):
+def getAllRunningFiles(jobs, manifest_dir=None):
     """
     Get all files that are still running or are currently pending
+    
+    @manifest_dir the folder with the manifests of the array jobs, if given their files are included
     """
     if jobs.empty:
         return pd.DataFrame(columns=['files','night','runId'])
     
-    jobs = jobs[jobs.name.str.startswith('eventlist_')]
+    files = jobs.name[jobs.name.str.startswith('eventlist_')].str[10:]
     
-    files = jobs.name.str[10:]
-    night = jobs.name.str[10:18].astype(int)
-    runId = jobs.name.str[19:22].astype(int)
+    if manifest_dir is not None:
+        arrayFiles = []
+        for name in jobs.name[jobs.name.str.startswith('elarray_')].unique():
+            manifest = os.path.join(manifest_dir, name+".txt")
+            if os.path.exists(manifest):
+                arrayFiles.extend(os.path.basename(path) for path in read_manifest(manifest))
+        files = pd.concat([files, pd.Series(arrayFiles, dtype=object)], ignore_index=True)
+    
+    night = files.str[0:8].astype(int)
+    runId = files.str[9:12].astype(int)
     
     df = pd.DataFrame({'files':files, 'night':night, 'runId':runId})
     return df
 
+def getPendingJobs(jobs, engine):
+    """
+    Get all jobs that are still waiting in the queue
+    """
+    if jobs.empty:
+        return jobs
+    if engine == "PBS":
+        return jobs.query('state == "Q"')
+    return jobs.query('state == "pending"')
 
-def add_new_files(limit, rawfolder, fs):
+
+def shiftNight(night, days):
+    """
+    Returns the night the given amount of days later, or earlier for negative days
+    """
+    date = datetime.strptime(str(night), '%Y%m%d') + timedelta(days=days)
+    return int(date.strftime('%Y%m%d'))
+
+
+def add_new_files(limit, rawfolder, fs, state_file=None, full_discovery=False, full_discovery_interval=None, overlap=7):
     """
     Checks for new files and adds them to the processing db
     
     @limit only add this amount of new files
     @fs the filesystem to use
+    @state_file file with the watermark, the last night up to which all files are in the processing db.
+        If given only the nights after the watermark, minus the overlap in days for late arriving files,
+        are checked
+    @full_discovery check all nights, also done when the last full check is full_discovery_interval seconds ago
     """
+    state = load_json_state(state_file, {})
+    since = None
+    if state_file is not None and 'watermark' in state:
+        due = full_discovery_interval is not None and time.time() - state.get('last_full', 0) >= full_discovery_interval
+        if full_discovery or due:
+            logger.info("Checking all nights for new files")
+        else:
+            since = shiftNight(state['watermark'], -overlap)
+            logger.info("Checking the nights after {} for new files".format(since))
+    
     logger.debug("Getting all new files")
-    df = getAllNewFiles(limit)
+    df = getAllNewFiles(since=since)
+    truncated = limit is not None and len(df) > limit
+    if truncated:
+        df = df.head(limit)
     logger.info("Found: {} new files start processing".format(len(df)))
     
     # add all new files into the processing db
     if len(df) != 0:
         newFiles = []
         logger.debug("Prepare the new files for the database")
-        for index, row in df.iterrows():
-            night = row['night']
-            runId = row['runId']
-            path = returnPathIfExists(rawfolder, night, runId)
-            if not path:
+        # one directory listing per night instead of checking every file
+        nights = {night: listNight(rawfolder, night) for night in df['night'].unique()}
+        for night, runId in zip(df['night'], df['runId']):
+            ext = nights[night].get(runId)
+            if not ext:
                 # New file but missing on the filesystem
                 newFiles.append({'night':night, 'runId':runId, 'extension':"", 'status':0, fs:False})
             else:
-                ext = os.path.splitext(path)[1][1:]
                 newFiles.append({'night':night, 'runId':runId, 'extension':ext, 'status':0, fs:True})
         logger.info("Insert all new Files")
+        rows = max_rows_per_statement(1000, len(newFiles[0]))
         with processing_db.atomic():
-            ProcessingInfo.insert_many(newFiles).execute()
+            for start in range(0, len(newFiles), rows):
+                ProcessingInfo.insert_many(newFiles[start:start+rows]).execute()
     else:
         logger.info("No new files for the processing database")
     logger.info("Added new files")
+    
+    # all files after since are in the processing db now, unless the result was truncated
+    if state_file is not None and not truncated:
+        watermark = ProcessingInfo.select(pew.fn.MAX(ProcessingInfo.night)).scalar()
+        if watermark is not None:
+            state['watermark'] = int(watermark)
+        if since is None:
+            state['last_full'] = time.time()
+        save_json_state(state_file, state)
+        logger.debug("Discovery watermark: {}".format(state.get('watermark')))
+
+from .qsub import create_qsub, create_array_qsub, get_current_jobs
+
+class JobTracker:
+    """
+    Keeps track of the eventlist files in processing and the amount of pending jobs.
+    The scheduler is only asked again after the ttl ran out, in between the own
+    submissions are counted locally.
+    """
+    def __init__(self, engine, ttl=60, manifest_dir=None):
+        self.engine = engine
+        self.ttl = ttl
+        self.manifest_dir = manifest_dir
+        self.refresh()
+
+    def refresh(self):
+        """
+        Gets the current state of the jobs from the scheduler
+        """
+        logger.debug("Get all still running or pending files")
+        jobs = get_current_jobs(self.engine)
+        runningFiles = getAllRunningFiles(jobs, self.manifest_dir)
+        self.running = set(zip(runningFiles['night'], runningFiles['runId']))
+        self.pending = len(getPendingJobs(jobs, self.engine))
+        self.lastRefresh = time.monotonic()
+
+    def update(self):
+        """
+        Refreshes the state if it is older than the ttl
+        """
+        if time.monotonic() - self.lastRefresh >= self.ttl:
+            self.refresh()
+
+    def isRunning(self, night, runId):
+        """
+        Checks if the file is currently running or pending
+        """
+        self.update()
+        return (night, runId) in self.running
+
+    def numPending(self):
+        """
+        Returns the amount of pending jobs
+        """
+        self.update()
+        return self.pending
+
+    def submitted(self, files):
+        """
+        Adds the (night, runId) pairs of a newly submitted job
+        """
+        self.running.update(files)
+        self.pending += 1
 
-from .qsub import create_qsub,  get_current_jobs
 
 def nightToDate(night):
     year = night//10000
     month = (night%10000)//100
     day = night%100
     return year,  month,  day
+
+def getFilePath(rawfolder, night, runId, ext):
+    """
+    Returns the path of the raw file, if no extension is given assume fz
+    """
+    if len(ext) == 0:
+        ext = 'fz'
+    year,  month, day = nightToDate(night)
+    return os.path.join(rawfolder, "{:04d}/{:02d}/{:02d}/{:08d}_{:03d}.fits.{}".format(year, month, day, night, runId, ext))
     
 @click.command()
 @click.argument('rawfolder', type=click.Path(exists=True, dir_okay=True, file_okay=False, readable=True))
@@ -169,7 +281,11 @@ def nightToDate(night):
     help='specify if the amount of files to process should be limited and by how much.'
 )
 @click.option('--engine', help='Name of the grid engine used by the cluster.', type=click.Choice(['PBS', 'SGE',]), default='SGE')
-def processNewFiles(rawfolder, no_process, config, limit_new,  limit_process, verbose,  ignore_new,  fs,  usefile,  engine):
+@click.option('--files_per_task', type=int, default=None,
+    help='Submit array jobs processing this amount of files per task instead of one job per file.'
+)
+@click.option('--full_discovery', is_flag=True, help='Check all nights for new files, not only the ones after the discovery watermark')
+def processNewFiles(rawfolder, no_process, config, limit_new,  limit_process, verbose,  ignore_new,  fs,  usefile,  engine,  files_per_task,  full_discovery):
     """
     Processes all non processed files into the EventList db
     
@@ -219,7 +335,12 @@ def processNewFiles(rawfolder, no_process, config, limit_new,  limit_process, ve
     connect_database(fact_db_config)
     
     if not ignore_new:
-        add_new_files(limit_new, rawfolder, fs)
+        add_new_files(limit_new, rawfolder, fs,
+            state_file=os.path.join(config['submitter']['data_directory'], "discovery_state.json"),
+            full_discovery=full_discovery,
+            full_discovery_interval=config['submitter'].get('full_discovery_interval'),
+            overlap=config['submitter'].get('discovery_overlap', 7),
+        )
 
     if no_process:
         logger.info("Not processing files")
@@ -234,7 +355,7 @@ def processNewFiles(rawfolder, no_process, config, limit_new,  limit_process, ve
     os.makedirs(log_dir, exist_ok=True)
     if usefile:
         output_folder = os.path.join(config['submitter']['data_directory'], "output")
-        os.makedirs(output_folder,  exists_ok=True)
+        os.makedirs(output_folder,  exist_ok=True)
     
     qsub_env = {
         "WALLTIME": walltime,
@@ -242,12 +363,20 @@ def processNewFiles(rawfolder, no_process, config, limit_new,  limit_process, ve
     }
     if usefile:
         qsub_env['OUT_FILE'] = "True"
+        qsub_env['OUT_FORMAT'] = config['submitter'].get('out_format', 'csv')
+    if 'jobs_per_task' in config['submitter']:
+        qsub_env['JOBS'] = config['submitter']['jobs_per_task']
     
     qsub_kwargs = {
         'mail_address' : config['submitter']['mail_address'],
         'mail_settings' : config['submitter']['mail_settings'],
         'queue' : queue,
+        'engine' : engine,
     }
+    if 'array_flag' in config['submitter']:
+        qsub_kwargs['array_flag'] = config['submitter']['array_flag']
+    if 'parallel_environment' in config['submitter']:
+        qsub_kwargs['parallel_environment'] = config['submitter']['parallel_environment']
     
     qsub_res = {
         'vmem' : config['submitter']['memory'],
@@ -258,60 +387,82 @@ def processNewFiles(rawfolder, no_process, config, limit_new,  limit_process, ve
     logger.info("Process all unprocessed files")
     if limit_process is not None:
         logger.info("Processing maximum of {} files".format(limit_process))
+    manifest_dir = os.path.join(config['submitter']['data_directory'], "manifests")
+    os.makedirs(manifest_dir, exist_ok=True)
     try:
-        for index, row in df.iterrows():
+        tracker = JobTracker(engine, config['submitter'].get('job_state_ttl', 60), manifest_dir)
+        if files_per_task:
+            max_tasks = config['submitter'].get('max_array_tasks', 1000)
+            
+            runs = [
+                (row.night, row.runId, getFilePath(rawfolder, row.night, row.runId, row.extension))
+                for row in df.itertuples()
+                if not tracker.isRunning(row.night, row.runId)
+            ]
             if limit_process is not None:
-                if index==limit_process:
-                    logger.info("Reached allowed limit of files to process")
-                    break
+                runs = runs[:limit_process]
+            logger.info("Submitting {} files as array jobs with {} files per task".format(len(runs), files_per_task))
             
-            night = row['night']
-            runId = row['runId']
+            filesPerJob = max_tasks*files_per_task
+            for start in range(0, len(runs), filesPerJob):
+                jobRuns = runs[start:start+filesPerJob]
+                name = "elarray_{}_{}".format(time.strftime('%Y%m%d%H%M%S'), start//filesPerJob)
+                manifest = os.path.join(manifest_dir, name+".txt")
+                write_manifest(manifest, [path for night, runId, path in jobRuns])
+                num_tasks = (len(jobRuns)+files_per_task-1)//files_per_task
+                
+                qsub_cmd = create_array_qsub(manifest, num_tasks, files_per_task, log_dir, qsub_env, qsub_res, qsub_kwargs,
+                    task_walltime=config['submitter'].get('task_walltime'))
+                logger.debug("Qsub command:")
+                logger.debug(qsub_cmd)
+                while tracker.numPending() >= max_queued_jobs:
+                    logger.debug("Wait for jobs to clear up: {}/{}".format(tracker.numPending(), max_queued_jobs))
+                    time.sleep(interval)
+                    tracker.refresh()
+                logger.info("Sending array job with {} tasks to qsub".format(num_tasks))
+                output = sp.check_output(qsub_cmd)
+                logger.debug(output.decode().strip())
+                tracker.submitted((night, runId) for night, runId, path in jobRuns)
+        else:
+            for index, row in df.iterrows():
+                if limit_process is not None:
+                    if index==limit_process:
+                        logger.info("Reached allowed limit of files to process")
+                        break
             
-            ext = row['extension']
-            if len(ext) == 0: # if no extension is given assume fz
-                ext = 'fz'
-            year,  month, day = nightToDate(night)
-        
-            path = os.path.join(rawfolder, "{:04d}/{:02d}/{:02d}/{:08d}_{:03d}.fits.{}".format(year, month, day, night, runId, ext))
-            logger.info("Processing night: {}, runId:{}".format(night, runId))
-            logger.info("  Path: "+path);
+                night = row['night']
+                runId = row['runId']
             
-            logger.debug("Get all still running or pending files")
-            current_jobs = get_current_jobs(engine)
-            runningFiles = getAllRunningFiles(current_jobs)
+                path = getFilePath(rawfolder, night, runId, row['extension'])
+                logger.info("Processing night: {}, runId:{}".format(night, runId))
+                logger.info("  Path: "+path);
             
-            # TODO check for finished files here also
-            if ((runningFiles['night'] == night) & (runningFiles['runId'] == runId)).any():
-                logger.info("  File already in processing skipping")
-                continue
+                # TODO check for finished files here also
+                if tracker.isRunning(night, runId):
+                    logger.info("  File already in processing skipping")
+                    continue
             
-            # create qsub command
-            qsub_cmd = create_qsub(path, log_dir, qsub_env, qsub_res,  qsub_kwargs)
+                # create qsub command
+                qsub_cmd = create_qsub(path, log_dir, qsub_env, qsub_res,  qsub_kwargs)
             
-            logger.debug("Qsub command:")
-            logger.debug(qsub_cmd)
-            # execute
-            while True:
-                if engine == "PBS":
-                    pending_jobs = current_jobs.query('state == "Q"')
-                else:
-                    pending_jobs = current_jobs.query('state == "pending"')
-                if len(pending_jobs) < max_queued_jobs:
-                    logger.info("Sending to qsub")
-                    output = sp.check_output(qsub_cmd)
-                    logger.debug(output.decode().strip())
-                    break
-                logger.debug("Wait for jobs to clear up: {}/{}".format(len(pending_jobs), max_queued_jobs))
+                logger.debug("Qsub command:")
+                logger.debug(qsub_cmd)
+                # execute
+                while tracker.numPending() >= max_queued_jobs:
+                    logger.debug("Wait for jobs to clear up: {}/{}".format(tracker.numPending(), max_queued_jobs))
+                    time.sleep(interval)
+                    tracker.refresh()
+                logger.info("Sending to qsub")
+                output = sp.check_output(qsub_cmd)
+                logger.debug(output.decode().strip())
+                tracker.submitted([(night, runId)])
                 time.sleep(interval)
-                current_jobs = get_current_jobs()
-            time.sleep(interval)
             
     except (KeyboardInterrupt, SystemExit):
         logger.info('Shutting done')
         logger.info('Clean up running jobs')
-        current_jobs = get_current_jobs()
-        myjobs = current_jobs[current_jobs.name.str.startswith('eventlist_')]
+        current_jobs = get_current_jobs(engine)
+        myjobs = current_jobs[current_jobs.name.str.startswith('eventlist_') | current_jobs.name.str.startswith('elarray_')]
         logger.info("Removing {} jobs".format(len(myjobs)))
         for index, job in myjobs.iterrows():
             logger.debug("Close job: {}".format(job['name']))
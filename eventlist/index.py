@@ -0,0 +1,168 @@
+import logging
+from collections import OrderedDict
+import numpy as np
+
+from .data import EVENT_DTYPE, EVENTLIST_COLUMNS
+from .model import Event, RunEvents, max_rows_per_statement
+from .packed import unpack_run
+from .utils import night_run_condition
+
+log = logging.getLogger(__name__)
+
+
+class EventIndex:
+    """
+    Query interface of the eventlist returning the events as numpy structured arrays of EVENT_DTYPE
+
+    The events of several runs are fetched with one query per runs_per_query runs. The results are kept
+    per run in an LRU cache holding at most cache_events events, so repeated requests for the same runs
+    don't go to the database again. The processing db has to be connected.
+
+    @storage 'rows' to read the Event table, 'packed' to read the run packed RunEvents table
+    @fallback read the runs without events in the storage from the other table, for databases
+        where the storage was changed and older runs are still in the other table
+    """
+    def __init__(self, cache_events=10000000, runs_per_query=500, storage='rows', fallback=False):
+        if storage not in ('rows', 'packed'):
+            raise ValueError("Unknown storage: '{}'".format(storage))
+        self.cache_events = cache_events
+        self.runs_per_query = runs_per_query
+        self.storage = storage
+        self.fallback = fallback
+        self.cache = OrderedDict()
+        self.cachedEvents = 0
+
+    def cacheKey(self, night, runId, event_types):
+        return int(night), int(runId), None if event_types is None else tuple(sorted(event_types))
+
+    def addToCache(self, key, events):
+        if self.cache_events <= 0:
+            return
+        self.cache[key] = events
+        # empty runs count as one event, so they can't fill the cache without bounds
+        self.cachedEvents += max(len(events), 1)
+        while self.cachedEvents > self.cache_events:
+            oldKey, oldEvents = self.cache.popitem(last=False)
+            self.cachedEvents -= max(len(oldEvents), 1)
+
+    def fetchPacked(self, runs, event_types):
+        """
+        Fetches the RunEvents rows of the runs and decodes them, returns a dict (night, runId) -> events
+        """
+        result = {run: np.empty(0, dtype=EVENT_DTYPE) for run in runs}
+        runs_per_query = max_rows_per_statement(self.runs_per_query, 2)
+        for start in range(0, len(runs), runs_per_query):
+            chunk = runs[start:start+runs_per_query]
+            query = RunEvents.select().where(night_run_condition(RunEvents.night, RunEvents.runId, chunk))
+            for row in list(query):
+                events = unpack_run(row)
+                if event_types is not None:
+                    events = events[np.isin(events['eventType'], list(event_types))]
+                result[(row.night, row.runId)] = events
+        return result
+
+    def fetch(self, runs, event_types):
+        """
+        Fetches the events of the runs from the database, returns a dict (night, runId) -> events
+        """
+        fetchStorage = self.fetchPacked if self.storage == 'packed' else self.fetchRows
+        result = fetchStorage(runs, event_types)
+        if self.fallback:
+            fetchOther = self.fetchRows if self.storage == 'packed' else self.fetchPacked
+            missing = [run for run in runs if len(result[run]) == 0]
+            if missing:
+                result.update(fetchOther(missing, event_types))
+        return result
+
+    def fetchRows(self, runs, event_types):
+        """
+        Fetches the events of the runs from the Event table, returns a dict (night, runId) -> events
+        """
+        result = {run: np.empty(0, dtype=EVENT_DTYPE) for run in runs}
+        # the trigger types are part of the condition of every night, so the (eventType, night, runId) index
+        # is used for each of them, every run needs at most a night, a runId and the trigger type parameters
+        typeCondition = None if event_types is None else Event.eventType << list(event_types)
+        runs_per_query = max_rows_per_statement(self.runs_per_query, 2 + len(event_types or []))
+        for start in range(0, len(runs), runs_per_query):
+            chunk = runs[start:start+runs_per_query]
+            query = (
+                Event.select(*[getattr(Event, c) for c in EVENTLIST_COLUMNS])
+                .where(night_run_condition(Event.night, Event.runId, chunk, typeCondition))
+                .order_by(Event.night, Event.runId, Event.eventNr)
+                .tuples()
+            )
+            events = np.array(list(query), dtype=EVENT_DTYPE)
+            log.debug("Fetched {} events of {} runs".format(len(events), len(chunk)))
+
+            # split the events at the changes of night or runId
+            changes = np.flatnonzero((np.diff(events['night']) != 0) | (np.diff(events['runId']) != 0)) + 1
+            for runEvents in np.split(events, changes):
+                if len(runEvents) > 0:
+                    result[(int(runEvents['night'][0]), int(runEvents['runId'][0]))] = runEvents
+        return result
+
+    def events_by_run(self, pairs, event_types=None):
+        """
+        Returns a dict (night, runId) -> events of the given runs, only the runs missing in the cache are fetched.
+        The arrays are the cached ones and read only, copy them before changing them
+        """
+        runs = sorted(set((int(night), int(runId)) for night, runId in pairs))
+        result = {}
+        missing = []
+        for night, runId in runs:
+            key = self.cacheKey(night, runId, event_types)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                result[(night, runId)] = self.cache[key]
+            else:
+                missing.append((night, runId))
+
+        if missing:
+            for run, events in self.fetch(missing, event_types).items():
+                # the arrays are shared with the cache, so they are handed out read only
+                events.setflags(write=False)
+                self.addToCache(self.cacheKey(run[0], run[1], event_types), events)
+                result[run] = events
+        return result
+
+    def events_for_runs(self, pairs, event_types=None):
+        """
+        Returns the events of the given (night, runId) pairs, sorted by night, runId and eventNr
+
+        @event_types only return events of these trigger types
+        """
+        byRun = self.events_by_run(pairs, event_types)
+        if not byRun:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        return np.concatenate([byRun[run] for run in sorted(byRun)])
+
+    def events_for_run(self, night, runId, event_types=None):
+        """
+        Returns the events of one run sorted by eventNr, as read only array
+
+        @event_types only return events of these trigger types
+        """
+        return self.events_by_run([(night, runId)], event_types)[(int(night), int(runId))]
+
+    def lookup(self, coords):
+        """
+        Returns the events with the given (night, runId, eventNr) coordinates in their order,
+        coordinates without an event in the eventlist are left out
+        """
+        coords = np.array([tuple(c) for c in coords], dtype=np.int64).reshape(-1, 3)
+        byRun = self.events_by_run(coords[:, :2])
+
+        found = []
+        for night, runId, eventNr in coords:
+            events = byRun[(int(night), int(runId))]
+            pos = np.searchsorted(events['eventNr'], eventNr)
+            if pos < len(events) and events['eventNr'][pos] == eventNr:
+                found.append(events[pos])
+        return np.array(found, dtype=EVENT_DTYPE)
+
+    def clear(self):
+        """
+        Empties the cache
+        """
+        self.cache.clear()
+        self.cachedEvents = 0
@@ -0,0 +1,233 @@
+import click
+import logging
+import sys
+import time
+
+from fact.instrument import trigger
+
+from .model import (Event, processing_db, init_processing_db, is_sqlite,
+    UnsignedTinyIntegerField, UnsignedSmallIntegerField, UnsignedMediumIntegerField, UnsignedIntegerField)
+from .bulk import EVENT_COLUMNS, quote
+from .utils import load_config
+
+logger = logging.getLogger('EventList_Migration')
+logger.setLevel(logging.DEBUG)
+logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+# values of the generated triggerClass column, every other trigger type is 'other'
+TRIGGER_CLASSES = [
+    ('physics', trigger.PHYSICS),
+    ('pedestal', trigger.PEDESTAL),
+    ('lightpulser_ext', trigger.LIGHT_PULSER_EXTERNAL),
+    ('lightpulser_int', trigger.LIGHT_PULSER_INTERNAL),
+    ('time_calibration', trigger.TIME_CALIBRATION),
+    ('ext1', trigger.EXT1),
+    ('ext2', trigger.EXT2),
+]
+
+# FACT started taking data in 2011
+FIRST_YEAR = 2011
+
+# value ranges of the unsigned column types, events of the old table outside of them are not copied
+FIELD_RANGES = {
+    UnsignedTinyIntegerField: (0, 2**8-1),
+    UnsignedSmallIntegerField: (0, 2**16-1),
+    UnsignedMediumIntegerField: (0, 2**24-1),
+    UnsignedIntegerField: (0, 2**32-1),
+}
+
+
+def partition_clause(last_year):
+    """
+    Returns the clause partitioning the table by night with one partition per year
+    and one for all nights after last_year
+    """
+    partitions = [
+        "PARTITION p{0} VALUES LESS THAN ({1}0000)".format(year, year+1)
+        for year in range(FIRST_YEAR, last_year+1)
+    ]
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return "PARTITION BY RANGE ({}) ({})".format(quote('night'), ', '.join(partitions))
+
+
+def create_table_sql(table, last_year):
+    """
+    Returns the statement creating the eventlist table with the schema of the Event model, partitioned by night
+    """
+    sql, params = processing_db.compiler().create_table(Event, safe=True)
+    sql = sql.replace(quote(Event._meta.db_table), quote(table), 1)
+    return sql + ' ' + partition_clause(last_year)
+
+
+def create_index_sql(table):
+    """
+    Returns the statements creating the secondary indexes of the Event model,
+    the index names are the ones of the final table
+    """
+    compiler = processing_db.compiler()
+    return [
+        "CREATE {}INDEX {} ON {} ({})".format(
+            'UNIQUE ' if unique else '',
+            quote(compiler.index_name(Event._meta.db_table, columns)),
+            quote(table),
+            ', '.join(quote(c) for c in columns),
+        )
+        for columns, unique in Event._meta.indexes
+    ]
+
+
+def trigger_class_sql(table):
+    """
+    Returns the statement adding the triggerClass column, decoded from the eventType.
+    It is a virtual column, so it takes no space in the table
+    """
+    names = ', '.join("'{}'".format(name) for name, value in TRIGGER_CLASSES)
+    cases = ' '.join("WHEN {} THEN '{}'".format(value, name) for name, value in TRIGGER_CLASSES)
+    return "ALTER TABLE {} ADD COLUMN {} ENUM({}, 'other') AS (CASE {} {} ELSE 'other' END) VIRTUAL".format(
+        quote(table), quote('triggerClass'), names, quote('eventType'), cases)
+
+
+def valid_condition():
+    """
+    Returns the condition of the events whose values fit into the columns of the Event model
+    """
+    conditions = []
+    for name in EVENT_COLUMNS:
+        low, high = FIELD_RANGES[type(Event._meta.fields[name])]
+        conditions.append("{} BETWEEN {} AND {}".format(quote(name), low, high))
+    return ' AND '.join(conditions)
+
+
+def copy_sql(source, target):
+    """
+    Returns the statement copying the valid events of a range of nights, given as parameters, into the new table.
+    Events with values out of the range of the new columns are left out instead of being truncated
+    """
+    columns = ', '.join(quote(c) for c in EVENT_COLUMNS)
+    return "INSERT INTO {} ({}) SELECT {} FROM {} WHERE {} BETWEEN {} AND {} AND {}".format(
+        quote(target), columns, columns, quote(source), quote('night'),
+        processing_db.interpolation, processing_db.interpolation, valid_condition())
+
+
+def invalid_count_sql(source):
+    """
+    Returns the statement counting the events of a range of nights, given as parameters,
+    that are left out by copy_sql
+    """
+    return "SELECT COUNT(*) FROM {} WHERE {} BETWEEN {} AND {} AND NOT ({})".format(
+        quote(source), quote('night'), processing_db.interpolation, processing_db.interpolation, valid_condition())
+
+
+def month_ranges(firstnight, lastnight):
+    """
+    Yields the first and last night of every month from firstnight to lastnight
+    """
+    year, month = firstnight // 10000, firstnight // 100 % 100
+    while year*10000 + month*100 <= lastnight:
+        yield year*10000 + month*100, year*10000 + month*100 + 99
+        year, month = (year+1, 1) if month == 12 else (year, month+1)
+
+
+def scalar(sql):
+    """
+    Returns the first column of the first row of the query result
+    """
+    return processing_db.execute_sql(sql).fetchone()[0]
+
+
+@click.command()
+@click.option(
+    '--config', '-c', envvar='EVENTLIST_CONFIG',
+    help='Config file, if not given, env EVENTLIST_CONFIG and ./eventlist.yaml will be tried'
+)
+@click.option('--dry_run', is_flag=True, help='Only print the statements changing the database')
+@click.option('--trigger_class', is_flag=True, help='Add the triggerClass column decoded from the eventType')
+@click.option('--last_year', type=int, default=time.gmtime().tm_year + 1, help='Last year with its own partition, later nights go into one partition')
+def migrateEventList(config, dry_run, trigger_class, last_year):
+    """
+    Migrates the eventlist table to the current schema, partitioned by night
+
+    The events are copied month by month into a new table which then replaces the old one, the old table
+    is kept as EventList_old. Stop all jobs writing into the eventlist before, events they add to already
+    copied months would be missing. Every month is copied with one statement, so an interrupted migration
+    continues with the month after the last copied one. Events with values that don't fit into the new
+    columns are counted and logged per month, they are only kept in EventList_old.
+    """
+    logger.info("Loading config")
+    if not config:
+        logger.error("No config specified, can't work without it")
+        return
+    config, configpath = load_config(config)
+
+    logger.info("Connecting to processing db")
+    init_processing_db(config['processing_database'])
+    if is_sqlite():
+        logger.error("The migration is only needed for the mysql backend")
+        return
+    processing_db.connect()
+
+    table = Event._meta.db_table
+    newTable = table + "_new"
+    oldTable = table + "_old"
+
+    def execute(sql, params=None):
+        if dry_run:
+            logger.info(sql if params is None else "{}  {}".format(sql, params))
+            return
+        start = time.monotonic()
+        processing_db.execute_sql(sql, params)
+        logger.debug("  took {:.1f} s".format(time.monotonic() - start))
+
+    tables = processing_db.get_tables()
+    if table in tables:
+        if 'PARTITION BY' in processing_db.execute_sql("SHOW CREATE TABLE {}".format(quote(table))).fetchone()[1]:
+            logger.info("The eventlist table is already migrated")
+            return
+        target = newTable
+    else:
+        logger.info("No eventlist table yet, creating it")
+        target = table
+
+    if target not in tables:
+        logger.info("Creating table: {}".format(target))
+        execute(create_table_sql(target, last_year))
+        for sql in create_index_sql(target):
+            execute(sql)
+        if trigger_class:
+            execute(trigger_class_sql(target))
+    elif trigger_class and 'triggerClass' not in [c.name for c in processing_db.get_columns(target)]:
+        execute(trigger_class_sql(target))
+
+    if target == table:
+        logger.info("Finished")
+        return
+
+    firstnight = scalar("SELECT MIN({0}) FROM {1}".format(quote('night'), quote(table)))
+    lastnight = scalar("SELECT MAX({0}) FROM {1}".format(quote('night'), quote(table)))
+    if firstnight is not None:
+        months = list(month_ranges(firstnight, lastnight))
+        if newTable in tables:
+            # continue after the month of the last copied events
+            copied = scalar("SELECT MAX({0}) FROM {1}".format(quote('night'), quote(newTable)))
+            if copied is not None:
+                logger.info("Continuing the copy after night: {}".format(copied))
+                months = [(first, last) for first, last in months if first > copied]
+
+        skipped = 0
+        for first, last in months:
+            if dry_run:
+                logger.info("{}  {}".format(invalid_count_sql(table), [first, last]))
+            else:
+                invalid = processing_db.execute_sql(invalid_count_sql(table), [first, last]).fetchone()[0]
+                if invalid:
+                    logger.warning("{} events of the nights {} to {} have values out of range, they are not copied".format(
+                        invalid, first, last))
+                    skipped += invalid
+            logger.info("Copying the events of the nights {} to {}".format(first, last))
+            execute(copy_sql(table, newTable), [first, last])
+        if skipped:
+            logger.warning("{} events with values out of range were not copied, they are kept in: {}".format(skipped, oldTable))
+
+    logger.info("Replacing the eventlist table, the old one is kept as: {}".format(oldTable))
+    execute("RENAME TABLE {} TO {}, {} TO {}".format(quote(table), quote(oldTable), quote(newTable), quote(table)))
+    logger.info("Finished")
@@ -6,9 +6,44 @@ from playhouse.shortcuts import RetryOperationalError
 class MyRetryDB(RetryOperationalError, pew.MySQLDatabase):
     pass
 
-processing_db = MyRetryDB(None)
+# no retries on sqlite: its usual OperationalError is a lock timeout, and a retry on a new connection
+# would run the rest of an interrupted transaction in autocommit, waiting for locks is done by timeout
+class SqliteDB(pew.SqliteDatabase):
+    pass
+
+# column types of the unsigned fields below
+MyRetryDB.register_fields({
+    'utinyint': 'TINYINT UNSIGNED',
+    'usmallint': 'SMALLINT UNSIGNED',
+    'umediumint': 'MEDIUMINT UNSIGNED',
+    'uint': 'INTEGER UNSIGNED',
+    'longblob': 'LONGBLOB',
+})
+SqliteDB.register_fields({
+    'utinyint': 'INTEGER',
+    'usmallint': 'INTEGER',
+    'umediumint': 'INTEGER',
+    'uint': 'INTEGER',
+    'longblob': 'BLOB',
+})
+
+# pragmas of the sqlite backend: write ahead log, so readers don't block the writer,
+# no sync on every commit, 256 MB page cache and memory mapped reads
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -256000),
+    ('temp_store', 'memory'),
+    ('mmap_size', 2**30),
+]
+
+# maximum amount of parameters of one sqlite statement
+SQLITE_MAX_PARAMS = 999
+
+# the database is chosen by connect_processing_db
+processing_db = pew.Proxy()
 
-__all__ = ['processing_db_config', 'Event', 'ProcessStatus', 'ProcessingInfo', 'connect_processing_db',  'processing_db']
+__all__ = ['processing_db_config', 'Event', 'RunEvents', 'RunSummary', 'ProcessStatus', 'ProcessingInfo', 'connect_processing_db',  'processing_db']
 
 processing_db_config = {
     "host" : "fact-mysql.app.tu-dortmund.de",
@@ -18,25 +53,98 @@ processing_db_config = {
 }
 
 
+class UnsignedTinyIntegerField(pew.IntegerField):
+    db_field = 'utinyint'
+
+class UnsignedSmallIntegerField(pew.IntegerField):
+    db_field = 'usmallint'
+
+class UnsignedMediumIntegerField(pew.IntegerField):
+    db_field = 'umediumint'
+
+class UnsignedIntegerField(pew.IntegerField):
+    db_field = 'uint'
+
+class LongBlobField(pew.BlobField):
+    db_field = 'longblob'
+
+
 class Event(pew.Model):
     """
     Eventlist database model
+
+    The events are identified by night, runId and eventNr, the index on eventType, night and runId
+    serves the queries for the events of a trigger type, e.g. the noise db.
+    el_migrate_index converts existing tables and partitions the table by night.
     """
-    night = pew.IntegerField()
-    runId = pew.SmallIntegerField()
-    eventNr = pew.IntegerField()
-    UTC = pew.IntegerField()
-    UTCus = pew.IntegerField()
-    eventType = pew.SmallIntegerField()
-    runType = pew.SmallIntegerField()
+    night = UnsignedIntegerField()
+    runId = UnsignedSmallIntegerField()
+    eventNr = UnsignedIntegerField()
+    UTC = UnsignedIntegerField()
+    UTCus = UnsignedMediumIntegerField()
+    eventType = UnsignedSmallIntegerField()
+    runType = UnsignedTinyIntegerField()
     
     class Meta:
         database = processing_db
         db_table = "EventList"
+        primary_key = pew.CompositeKey('night', 'runId', 'eventNr')
         indexes = (
-            (('night', 'runId', 'eventNr'), True),
+            (('eventType', 'night', 'runId'), False),
         )
 
+class RunEvents(pew.Model):
+    """
+    Run packed eventlist database model, one row holds all events of a run
+
+    The event columns are stored as compressed, partly delta encoded arrays,
+    see eventlist.packed for encoding and decoding them.
+    """
+    night = UnsignedIntegerField()
+    runId = UnsignedSmallIntegerField()
+    runType = UnsignedTinyIntegerField()
+    numEvents = UnsignedIntegerField()
+    eventNr = LongBlobField()
+    UTC = LongBlobField()
+    UTCus = LongBlobField()
+    eventType = LongBlobField()
+    
+    class Meta:
+        database = processing_db
+        db_table = "EventListRuns"
+        primary_key = pew.CompositeKey('night', 'runId')
+
+class RunSummary(pew.Model):
+    """
+    Summary of the events of every run in the eventlist, written together with the events
+    """
+    night = UnsignedIntegerField()
+    runId = UnsignedSmallIntegerField()
+    runType = UnsignedTinyIntegerField()
+    numEvents = UnsignedIntegerField()
+    # events per trigger type, see eventlist.summary
+    numPhysics = UnsignedIntegerField()
+    numPedestal = UnsignedIntegerField()
+    numLightPulserExt = UnsignedIntegerField()
+    numLightPulserInt = UnsignedIntegerField()
+    numTimeCalibration = UnsignedIntegerField()
+    numExt1 = UnsignedIntegerField()
+    numExt2 = UnsignedIntegerField()
+    numOther = UnsignedIntegerField()
+    minEventNr = UnsignedIntegerField()
+    maxEventNr = UnsignedIntegerField()
+    firstUTC = UnsignedIntegerField()
+    firstUTCus = UnsignedMediumIntegerField()
+    lastUTC = UnsignedIntegerField()
+    lastUTCus = UnsignedMediumIntegerField()
+    # amount of missing eventNr ranges between the first and the last event
+    numGaps = UnsignedIntegerField()
+    
+    class Meta:
+        database = processing_db
+        db_table = "RunSummary"
+        primary_key = pew.CompositeKey('night', 'runId')
+
 class ProcessStatus(Enum):
     not_processed = 0
     processed = 1
@@ -75,11 +183,45 @@ class ProcessingInfo(pew.Model):
         return fs in ProcessingInfo.getFileSystems()
     
 
+def init_processing_db(config):
+    """
+    Sets up the processing db given by the config, the backend key chooses between 'mysql', the default,
+    and 'sqlite' where database is the path of the database file. The other keys are passed to the database.
+    """
+    config = dict(config)
+    backend = config.pop('backend', 'mysql')
+    if backend == 'mysql':
+        processing_db.initialize(MyRetryDB(**config))
+    elif backend == 'sqlite':
+        config.setdefault('pragmas', SQLITE_PRAGMAS)
+        # wait for the lock of other writers instead of failing right away
+        config.setdefault('timeout', 60)
+        processing_db.initialize(SqliteDB(**config))
+    else:
+        raise ValueError("Unknown processing db backend: '{}'".format(backend))
+
+
+def is_sqlite():
+    """
+    Returns whether the processing db uses the sqlite backend
+    """
+    return isinstance(processing_db.obj, pew.SqliteDatabase)
+
+
+def max_rows_per_statement(rows, params_per_row, other_params=0):
+    """
+    Limits the rows of one statement to the amount of parameters the backend allows
+    """
+    if is_sqlite():
+        return max(1, min(rows, (SQLITE_MAX_PARAMS - other_params) // params_per_row))
+    return rows
+
+
 def connect_processing_db(config):
     """
     Connect to the processing db and create the tables if they don't exist yet
     """
-    processing_db.init(**config)
+    init_processing_db(config)
     processing_db.connect()
-    processing_db.create_tables([Event, ProcessingInfo], safe=True)
+    processing_db.create_tables([Event, RunEvents, RunSummary, ProcessingInfo], safe=True)
 
@@ -5,19 +5,22 @@ import pandas as pd
 from fact.factdb import *
 from fact.factdb.utils import read_into_dataframe
 
-from .utils import load_config
+from .utils import load_config, load_json_state, save_json_state
+from .noiseWriter import NoiseDBWriter, NOISE_DB_FORMATS, formatFromPath, mergeParts
 
 from peewee import SQL
+from multiprocessing import Pool
 import logging
+import os
 import sys
 
 logger = logging.getLogger('Noise_Databse')
 logger.setLevel(logging.DEBUG)
 logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
-def getDrsFiles(night):
+def getDrsFiles(firstnight=None, lastnight=None):
     """
-    Get all the drs files for the given night and return as a dataframe
+    Get all the drs files between the given nights and return them as a dataframe sorted by night and start time
     """
     query = (
         RunInfo.select(
@@ -28,77 +31,187 @@ def getDrsFiles(night):
         .where(RunInfo.fdrsstep == 2)
         .where(RunInfo.froi == 300)
         .where(RunInfo.fruntypekey == 2)
-        .where(RunInfo.fnight == night)
     )
+    if firstnight is not None:
+        query = query.where(RunInfo.fnight >= firstnight)
+    if lastnight is not None:
+        query = query.where(RunInfo.fnight <= lastnight)
     
     df = read_into_dataframe(query)
-    return df
+    return df.sort_values(['NIGHT', 'START']).reset_index(drop=True)
+
+def nightTimeKey(night, time):
+    """
+    Combines nights and unix times into one sortable int64 key
+    """
+    return (np.asarray(night, dtype=np.int64) << 32) | np.asarray(time, dtype=np.int64)
 
-def getClosestDrsFile(drsFiles, startTime):
+def getClosestDrsFiles(drsFiles, runs):
     """
-    Given a dataframe containing the drsfiles and a starttime calculate
-    the closest two drs files to this startTime
+    Given a dataframe containing the drsfiles sorted by night and start time, and a dataframe
+    with the night and the start time (UTC in unix seconds) of runs, calculate the closest two drs
+    files of the same night for every run. They are added as the columns drs0 and drs1.
+    If a night has only one drs file it is used for both, runs of nights without drs files are dropped.
     """
-    delta = np.abs(drsFiles['START']-pd.Timestamp(startTime))
+    drsNight = drsFiles['NIGHT'].values.astype(np.int64)
+    drsStart = drsFiles['START'].values.astype('datetime64[s]').astype(np.int64)
+    drsRunId = drsFiles['RUNID'].values
+    runNight = runs['night'].values.astype(np.int64)
+    runStart = runs['UTC'].values.astype(np.int64)
+    
+    # the drs files of the night of each run are in [first, last)
+    first = np.searchsorted(drsNight, runNight, side='left')
+    last = np.searchsorted(drsNight, runNight, side='right')
+    hasDrs = first < last
+    if not hasDrs.all():
+        logger.warning("No drs files for {} runs, skipping them".format((~hasDrs).sum()))
+    if not hasDrs.any():
+        return runs.iloc[0:0].assign(drs0=drsRunId[:0], drs1=drsRunId[:0])
+    
+    def distance(index):
+        valid = (index >= first) & (index < last)
+        delta = np.abs(drsStart[np.clip(index, 0, len(drsStart)-1)] - runStart)
+        return np.where(valid, delta, np.iinfo(np.int64).max)
     
-    # calculate closest
-    minIndex = np.argmin(delta)
-    # calculate second closest
-    if minIndex == len(drsFiles)-1:
-        secMinIndex = minIndex-1
-    elif minIndex == 0:
-        secMinIndex = 1
-    else:
-        secMinIndex = minIndex-1 if delta[minIndex-1]<delta[minIndex+1] else minIndex+1
+    # the closest two drs files are the closest of the neighbours around the start time
+    after = np.searchsorted(nightTimeKey(drsNight, drsStart), nightTimeKey(runNight, runStart))
+    before = after - 1
+    takeBefore = distance(before) <= distance(after)
+    closest = np.where(takeBefore, before, after)
+    before = np.where(takeBefore, before - 1, before)
+    after = np.where(takeBefore, after, after + 1)
+    second = np.where(distance(before) <= distance(after), before, after)
+    second = np.where((second >= first) & (second < last), second, closest)
     
-    return [drsFiles['RUNID'][minIndex], drsFiles['RUNID'][secMinIndex]]
+    runs = runs[hasDrs].copy()
+    runs['drs0'] = drsRunId[closest[hasDrs]]
+    runs['drs1'] = drsRunId[second[hasDrs]]
+    return runs
     
-'fNight <= 20140203 AND fNight >= 20131001 AND fSourceName = "Crab" AND fCurrentsMedMeanBeg < 8 AND fZenithDistanceMax < 30 AND fMoonZenithDistance > 100 AND fThresholdMinSet < 350 AND fEffectiveOn > 0.95 AND fTriggerRateMedian > 40 AND fTriggerRateMedian < 85 AND fThresholdMinSet < (14 * fCurrentsMedMeanBeg + 265)'
+from .model import connect_processing_db, ProcessingInfo
+from .index import EventIndex
 
-def getRunInfos(night, runid, condition=None):
+# trigger types of the events used for the noise db
+NOISE_EVENT_TYPES = [1, 1024]
+RUN_INFO_COLUMNS = ['currents', 'Zd', 'source','moonZdDist']
+# columns of the noise db with their types in parquet files
+NOISE_DB_SCHEMA = [
+    ('eventNr', 'int64'),
+    ('UTC', 'int64'),
+    ('NIGHT', 'int64'),
+    ('RUNID', 'int64'),
+    ('drs0', 'int64'),
+    ('drs1', 'int64'),
+    ('currents', 'double'),
+    ('Zd', 'double'),
+    ('source', 'string'),
+    ('moonZdDist', 'double'),
+]
+NOISE_DB_COLUMNS = [name for name, type in NOISE_DB_SCHEMA]
+
+def getNoiseEvents(runs, runs_per_query=500, storage='rows'):
     """
-    Get the RunInfo for the given night and runid, if a query is given test it and if it fails return None to discard run
+    Get the noise events of the given (night, runId) pairs, runs_per_query runs are fetched with
+    one query and yielded as one dataframe, ordered by night, runId and eventNr
+
+    @storage the storage read first, 'rows' or 'packed', runs without noise events in it
+        are read from the other one, see EventIndex
     """
-    query = (
-        RunInfo.select(
-            RunInfo.fnight,
-            RunInfo.frunid,
-            RunInfo.fcurrentsmedmean,
-            RunInfo.fcurrentsmedmeanbeg,
-            RunInfo.fzenithdistancemean,
-            RunInfo.fzenithdistancemax,
-            RunInfo.fmoonzenithdistance,
-            RunInfo.fthresholdminset,
-            RunInfo.feffectiveon,
-            RunInfo.ftriggerratemedian,
-            Source.fsourcename,
-        )
-        .join(Source, on=(Source.fsourcekey == RunInfo.fsourcekey))
-        .where(RunInfo.fnight == night)
-        .where(RunInfo.frunid == runid)
-    )
+    # every run is only needed once, so nothing is cached
+    index = EventIndex(cache_events=0, runs_per_query=runs_per_query, storage=storage, fallback=True)
+    for start in range(0, len(runs), runs_per_query):
+        events = index.events_for_runs(runs[start:start+runs_per_query], NOISE_EVENT_TYPES)
+        yield pd.DataFrame({c: events[c].astype(np.int64) for c in ['night', 'runId', 'eventNr', 'UTC']},
+            columns=['night', 'runId', 'eventNr', 'UTC'])
+
+def writeNoiseData(writer, drsFiles, df_processedruns, storage='rows'):
+    """
+    Fetches the noise events of the given runs, adds the closest drs files and the run infos
+    and writes them chunk by chunk with the writer
+    """
+    runs = sorted(zip(df_processedruns['night'], df_processedruns['runId']))
+    for events in getNoiseEvents(runs, storage=storage):
+        if len(events) == 0:
+            continue
+        # the first noise event of every run gives its start time
+        drs = getClosestDrsFiles(drsFiles, events.groupby(['night', 'runId'], as_index=False, sort=False)['UTC'].first())
+        logger.info("Processing {} runs from {}_{}".format(len(drs), events['night'].iloc[0], events['runId'].iloc[0]))
+        
+        events = events.merge(drs[['night', 'runId', 'drs0', 'drs1']], on=['night', 'runId'])
+        events = events.merge(df_processedruns, on=['night', 'runId'])
+        events.rename(columns={'night': 'NIGHT', 'runId': 'RUNID'}, inplace=True)
+        writer.write(events[NOISE_DB_COLUMNS])
+
+def shardByNight(df_processedruns, numShards):
+    """
+    Splits the runs into at most numShards dataframes of consecutive nights, in night order
+    """
+    nights = np.unique(df_processedruns['night'].values)
+    groups = np.array_split(nights, min(numShards, len(nights)))
+    return [df_processedruns[df_processedruns['night'].isin(group)] for group in groups]
+
+def initNoiseWorker(dbconfig, fact_db_config):
+    """
+    Opens the database connections of a worker process
+    """
+    connect_processing_db(dbconfig)
+    connect_database(fact_db_config)
+
+def processNoiseShard(args):
+    """
+    Writes the noise data of the runs of one shard into its own part file, returns the written events
+    """
+    part, out_format, storage, df_runs = args
+    drsFiles = getDrsFiles(int(df_runs['night'].min()), int(df_runs['night'].max()))
+    with NoiseDBWriter(part, out_format, schema=NOISE_DB_SCHEMA) as writer:
+        writeNoiseData(writer, drsFiles, df_runs, storage)
+    return writer.rows
+
+def buildNoiseDB(outdb, out_format, df_processedruns, jobs, dbconfig, fact_db_config, append=False, storage='rows'):
+    """
+    Writes the noise data of the given runs into outdb, with more than one job the runs are sharded by night
+    over a process pool. Returns the amount of written events.
+    """
+    if len(df_processedruns) == 0:
+        if out_format == 'parquet':
+            with NoiseDBWriter(outdb, out_format, schema=NOISE_DB_SCHEMA) as writer:
+                writer.write(pd.DataFrame(columns=NOISE_DB_COLUMNS))
+        elif not append:
+            NoiseDBWriter(outdb, out_format, schema=NOISE_DB_SCHEMA).close()
+        return 0
     
-    df = read_into_dataframe(query)
-    #print(df)
-    if len(df) == 0:
-        raise LookupError("Missing run infos")
+    if jobs > 1:
+        # several shards per worker, so a worker with slow nights doesn't hold up the others
+        shards = shardByNight(df_processedruns, 4*jobs)
+        parts = ['{}.part{:04d}'.format(outdb, i) for i in range(len(shards))]
+        logger.info("Process events of {} night shards with {} jobs".format(len(shards), jobs))
+        with Pool(jobs, initializer=initNoiseWorker, initargs=(dbconfig, fact_db_config)) as pool:
+            rows = sum(pool.imap_unordered(processNoiseShard, zip(parts, [out_format]*len(parts), [storage]*len(parts), shards)))
         
-    if condition is not None:
-        print(condition)
-        df.query(condition)
+        logger.info("Merging {} part files".format(len(parts)))
+        if mergeParts(outdb, out_format, parts, append) == 0 and out_format == 'parquet':
+            with NoiseDBWriter(outdb, out_format, schema=NOISE_DB_SCHEMA) as writer:
+                writer.write(pd.DataFrame(columns=NOISE_DB_COLUMNS))
+        return rows
     
-    if len(df)==0:
-        return None
-
-    current = df.fCurrentsMedMean.values[0]
-    zdDistMean = df.fZenithDistanceMean.values[0]
-    #zdDistMax = df.fZenithDistanceMax.values[0]
-    source = df.fSourceName.values[0]
-    moonZdDist = df.fMoonZenithDistance.values[0]
-    return [current, zdDistMean, source, moonZdDist]
+    logger.info("Load drs files")
+    drsFiles = getDrsFiles(int(df_processedruns['night'].min()), int(df_processedruns['night'].max()))
+    logger.info("Found {} drs files".format(len(drsFiles)))
+    
+    logger.info("Process events")
+    # every chunk of runs is written right away, so only one chunk is held in memory
+    with NoiseDBWriter(outdb, out_format, append, schema=NOISE_DB_SCHEMA) as writer:
+        writeNoiseData(writer, drsFiles, df_processedruns, storage)
+        if writer.rows == 0 and writer.format == 'parquet':
+            writer.write(pd.DataFrame(columns=NOISE_DB_COLUMNS))
+    return writer.rows
 
-from datetime import datetime
-from .model import Event, connect_processing_db, ProcessingInfo
+def writeBuildManifest(path, settings, runs, size):
+    """
+    Writes the settings, the (night, runId) pairs and the size of the output file of a noise db build
+    into its manifest, the old manifest is only replaced once the new one is complete
+    """
+    save_json_state(path, dict(settings, size=size, runs=[[int(night), int(runId)] for night, runId in sorted(runs)]))
 
 from fact_conditions import create_condition_set
 @click.command()
@@ -111,8 +224,11 @@ from fact_conditions import create_condition_set
 @click.option('--condition',  multiple=True,  help='Only use events that fullfill these condition types, can access condition set from fact_conditions.')
 @click.option('--fs', default='isdc', type=click.Choice(ProcessingInfo.getFileSystems()), help='Which filesystem to use: [isdc,fhgfs,bigtank]')
 @click.option('--source', help='Which source should be choosen')
+@click.option('--format', 'out_format', type=click.Choice(NOISE_DB_FORMATS), help='Output format, if not given it is taken from the extension of OUTDB (.gz, .zst, .parquet), json lines otherwise')
+@click.option('--jobs', '-j', default=1, type=int, help='Amount of worker processes, each processes its own nights')
+@click.option('--incremental', is_flag=True, help='Only append the runs processed since the last build of OUTDB, using the manifest written next to it')
 @click.argument('outdb', type=click.Path(exists=False, dir_okay=False, file_okay=True, readable=True) )
-def getNoiseDBcondition(outdb, config, firstnight, lastnight, condition, source, fs):
+def getNoiseDBcondition(outdb, config, firstnight, lastnight, condition, source, fs, out_format, jobs, incremental):
     """
     Create the noisedb from the EventListDB given a set of conditions to the used runs
     """
@@ -121,6 +237,43 @@ def getNoiseDBcondition(outdb, config, firstnight, lastnight, condition, source,
         logger.error("No config specified, can't work without it")
         return
     config, configpath = load_config(config)
+    
+    out_format = out_format or formatFromPath(outdb)
+    manifestPath = outdb + '.manifest.json'
+    settings = {
+        'conditions': sorted(condition),
+        'source': source,
+        'firstnight': firstnight,
+        'lastnight': lastnight,
+        'fs': fs,
+        'format': out_format,
+    }
+    doneRuns = []
+    if incremental:
+        if out_format == 'parquet':
+            logger.error("Incremental updates are only possible for json lines output, not parquet")
+            return
+        manifest = load_json_state(manifestPath)
+        if manifest is None or not os.path.exists(outdb):
+            logger.error("No previous build with a manifest found for: '{}'".format(outdb))
+            return
+        mismatch = [key for key in settings if manifest.get(key) != settings[key]]
+        if mismatch:
+            logger.error("Settings differ from the previous build: {}".format(', '.join(mismatch)))
+            return
+        doneRuns = [tuple(run) for run in manifest['runs']]
+
+        # events appended by an interrupted build are removed, they are appended again with their runs
+        size = os.path.getsize(outdb)
+        if size < manifest['size']:
+            logger.error("'{}' is smaller than after the previous build".format(outdb))
+            return
+        if size > manifest['size']:
+            logger.warning("Removing {} bytes appended by an interrupted build".format(size - manifest['size']))
+            os.truncate(outdb, manifest['size'])
+    elif os.path.exists(manifestPath):
+        # the output is rewritten, an interrupted rebuild must not be continued incrementally
+        os.remove(manifestPath)
 
     logger.debug("Connect to processing database")
     dbconfig  = config['processing_database']
@@ -130,9 +283,13 @@ def getNoiseDBcondition(outdb, config, firstnight, lastnight, condition, source,
     fact_db_config = config['fact_database']
     connect_database(fact_db_config)
     
-    # get all usable files
+    # get all usable files together with the run infos needed for the noise db
     query = (RunInfo.select(RunInfo.fnight.alias('night'),
-                           RunInfo.frunid.alias('runId'))
+                           RunInfo.frunid.alias('runId'),
+                           RunInfo.fcurrentsmedmean.alias('currents'),
+                           RunInfo.fzenithdistancemean.alias('Zd'),
+                           Source.fsourcename.alias('source'),
+                           RunInfo.fmoonzenithdistance.alias('moonZdDist'))
         .join(Source, on=(Source.fsourcekey == RunInfo.fsourcekey))
     )
     if firstnight is not None:
@@ -153,7 +310,7 @@ def getNoiseDBcondition(outdb, config, firstnight, lastnight, condition, source,
         logger.debug("Add condition for source: {}".format(source))
         query = query.where(Source.fsourcename==source)
 
-    df_runinfo = pd.DataFrame(list(query.dicts()))
+    df_runinfo = pd.DataFrame(list(query.dicts()), columns=['night', 'runId'] + RUN_INFO_COLUMNS)
     
     logger.info("Amout of admissable Runs: {}".format(len(df_runinfo)))
     
@@ -167,62 +324,21 @@ def getNoiseDBcondition(outdb, config, firstnight, lastnight, condition, source,
     # get all files that are still on the fiven filesystem
     query = query.where(getattr(ProcessingInfo, fs) == True)
     
-    df_processinginfo = pd.DataFrame(list(query.dicts()))
+    df_processinginfo = pd.DataFrame(list(query.dicts()), columns=['night', 'runId'])
     logger.info("Possible processed runs: {}".format(len(df_processinginfo)))
     df_processedruns = df_processinginfo.merge(df_runinfo, on=['night','runId'])
     logger.info("Possible processed runs with condition: {}".format(len(df_processedruns)))
     
     
-    curNight = 0
-    drsFiles = None
-    curRunId = 0
-    closestDrsFiles = None
-    runInfos = None
+    if incremental:
+        done = set(doneRuns)
+        isNew = [run not in done for run in zip(df_processedruns['night'], df_processedruns['runId'])]
+        df_processedruns = df_processedruns[np.array(isNew, dtype=bool)]
+        logger.info("New runs since the last build: {}".format(len(df_processedruns)))
     
-    noiseData = []
-    logger.info("Process events")
-    for index, row in df_processedruns.iterrows():
-        logger.info("Processing Run: {}_{}".format(row['night'],row['runId']))
-        query = ( Event.select()
-                .where(Event.night==row['night'])
-                .where(Event.runId==row['runId'])
-                .where((Event.eventType == 1024) | (Event.eventType == 1))
-        )
-        for d in query.iterator():
-            # check if the night changed if yes load the drs files for that night
-            night = d.night
-            if night != curNight:
-                logger.info("New night to process: "+str(night))
-                curNight = night
-                drsFiles = getDrsFiles(night)
-                logger.info("Drs Files for current night:")
-                logger.info(drsFiles)
-                curRunId = -1 # the night changed so the curRunId changed too
-            # check if the run changed if yes recalculate the closest drs file
-            runId = d.runId
-            if curRunId != runId:
-                logger.info("New runId to process: "+str(runId))
-                curRunId = runId
-                startTime = np.datetime64(datetime.utcfromtimestamp(d.UTC))
-                #print(startTime)
-                closestDrsFiles = getClosestDrsFile(drsFiles, startTime)
-                logger.info("Drs files for current run: {}".format(closestDrsFiles))
-                runInfos = getRunInfos(night, runId)
-                logger.info("Runinfos:")
-                logger.info(runInfos)
-            # infos about the runs are missing ignore
-            if runInfos is None:
-                logger.error("Missing run infos for run: {}_{}".format([night,  runId]))
-                continue
-
-            #print(d.eventNr)
-            res = [d.eventNr, d.UTC, d.night, d.runId, closestDrsFiles[0], closestDrsFiles[1]] + runInfos
-            noiseData.append(res)
-    
-    logger.info("Finished fetching all events. Creating database.")
-    
-    df_temp = pd.DataFrame(noiseData, columns=
-                ['eventNr', 'UTC','NIGHT','RUNID', 'drs0', 'drs1',
-                 'currents', 'Zd', 'source','moonZdDist'])
-    df_temp.to_json(outdb, orient='records', lines=True)
-    logger.info("Finished")
+    rows = buildNoiseDB(outdb, out_format, df_processedruns, jobs, dbconfig, fact_db_config, append=incremental,
+        storage=config.get('loader', {}).get('storage', 'rows'))
+    
+    writeBuildManifest(manifestPath, settings, doneRuns + list(zip(df_processedruns['night'], df_processedruns['runId'])),
+        os.path.getsize(outdb))
+    logger.info("Finished, wrote {} events".format(rows))
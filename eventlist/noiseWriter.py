@@ -0,0 +1,126 @@
+import gzip
+import os
+import shutil
+
+NOISE_DB_FORMATS = ['json', 'json.gz', 'json.zst', 'parquet']
+
+
+def formatFromPath(path):
+    """
+    Guess the format of the noise db from the file extension, json lines are the default
+    """
+    if path.endswith('.gz'):
+        return 'json.gz'
+    if path.endswith('.zst'):
+        return 'json.zst'
+    if path.endswith('.parquet'):
+        return 'parquet'
+    return 'json'
+
+
+class NoiseDBWriter:
+    """
+    Writes the noise db chunk by chunk as json lines, optionally gzip or zstd compressed, or as parquet file.
+    Only the current chunk is held in memory and everything written so far stays on disk.
+
+    @append Append to an existing json lines file, compressed files get a new gzip member or zstd frame
+    @schema list of (column, arrow type name) pairs of the parquet file, otherwise it is taken from the first chunk,
+        which fails for later chunks if a column of the first one is completely empty
+    """
+    def __init__(self, path, format=None, append=False, schema=None):
+        self.path = path
+        self.format = format or formatFromPath(path)
+        self.rows = 0
+        self.schema = schema
+        self.parquetWriter = None
+        mode = 'ab' if append else 'wb'
+        if append and self.format == 'parquet':
+            raise ValueError("Can't append to parquet files")
+
+        if self.format == 'json':
+            self.file = open(path, mode)
+        elif self.format == 'json.gz':
+            self.file = gzip.open(path, mode)
+        elif self.format == 'json.zst':
+            import zstandard
+            self.rawFile = open(path, mode)
+            self.file = zstandard.ZstdCompressor().stream_writer(self.rawFile)
+        elif self.format == 'parquet':
+            # parquet files are created with the first chunk
+            self.file = None
+        else:
+            raise ValueError("Unknown noise db format: '{}'".format(self.format))
+
+    def write(self, df):
+        """
+        Appends the rows of the dataframe
+        """
+        self.rows += len(df)
+        if self.format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = None
+            if self.schema is not None:
+                schema = pa.schema([(name, pa.type_for_alias(type)) for name, type in self.schema])
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            if self.parquetWriter is None:
+                self.parquetWriter = pq.ParquetWriter(self.path, table.schema)
+            self.parquetWriter.write_table(table)
+            return
+
+        if len(df) == 0:
+            return
+        lines = df.to_json(orient='records', lines=True)
+        if not lines.endswith('\n'):
+            lines += '\n'
+        self.file.write(lines.encode())
+
+    def close(self):
+        """
+        Finishes the file, a parquet file without any chunk is not created
+        """
+        if self.format == 'parquet':
+            if self.parquetWriter is not None:
+                self.parquetWriter.close()
+            return
+        self.file.close()
+        if self.format == 'json.zst':
+            self.rawFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def mergeParts(path, format, parts, append=False):
+    """
+    Merges the part files written with the same format into path in the given order and removes them,
+    with append they are added to the end of an existing json lines file.
+    Json lines, also gzip and zstd compressed ones, can be concatenated, parquet parts are rewritten row group by row group.
+    Parts that don't exist, because nothing was written into them, are skipped. Returns the amount of parts merged.
+    """
+    if append and format == 'parquet':
+        raise ValueError("Can't append to parquet files")
+    parts = [part for part in parts if os.path.exists(part)]
+    if format == 'parquet':
+        if parts:
+            import pyarrow.parquet as pq
+            writer = None
+            for part in parts:
+                partFile = pq.ParquetFile(part)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, partFile.schema_arrow)
+                for i in range(partFile.num_row_groups):
+                    writer.write_table(partFile.read_row_group(i))
+            writer.close()
+    else:
+        with open(path, 'ab' if append else 'wb') as f:
+            for part in parts:
+                with open(part, 'rb') as partFile:
+                    shutil.copyfileobj(partFile, f)
+
+    for part in parts:
+        os.remove(part)
+    return len(parts)
@@ -0,0 +1,102 @@
+import logging
+import zlib
+import numpy as np
+
+from .data import EVENT_DTYPE
+from .model import RunEvents, max_rows_per_statement
+
+log = logging.getLogger(__name__)
+
+# stored type of every packed column and whether it is delta encoded, the events are sorted by eventNr
+# so eventNr and UTC only change by small steps from event to event
+PACKED_COLUMNS = [
+    ('eventNr', '<i8', True),
+    ('UTC', '<i8', True),
+    ('UTCus', '<u4', False),
+    ('eventType', '<u2', False),
+]
+
+
+def encode_column(values, dtype, delta):
+    """
+    Encodes the column into compressed bytes, delta encoded columns store the differences to the previous value
+    """
+    values = np.asarray(values).astype(dtype)
+    if delta:
+        values = np.diff(values, prepend=values.dtype.type(0))
+    return zlib.compress(values.tobytes())
+
+
+def decode_column(blob, dtype, delta):
+    """
+    Decodes a column encoded with encode_column into an array
+    """
+    values = np.frombuffer(zlib.decompress(blob), dtype=dtype)
+    if delta:
+        values = np.cumsum(values)
+    return values
+
+
+def pack_run(night, runId, events):
+    """
+    Returns the fields of the RunEvents row holding the events of one run
+    """
+    order = np.argsort(np.asarray(events['eventNr']), kind='stable')
+    row = {
+        'night': int(night),
+        'runId': int(runId),
+        'runType': int(np.asarray(events['runType'])[0]) if len(order) else 0,
+        'numEvents': len(order),
+    }
+    for name, dtype, delta in PACKED_COLUMNS:
+        row[name] = encode_column(np.asarray(events[name])[order], dtype, delta)
+    return row
+
+
+def unpack_run(row):
+    """
+    Decodes a RunEvents row, or a dict of its fields, into a structured array with the eventlist dtypes
+    """
+    if not isinstance(row, dict):
+        row = {name: getattr(row, name) for name in ['night', 'runId', 'runType', 'numEvents'] + [c[0] for c in PACKED_COLUMNS]}
+    events = np.empty(row['numEvents'], dtype=EVENT_DTYPE)
+    events['night'] = row['night']
+    events['runId'] = row['runId']
+    events['runType'] = row['runType']
+    for name, dtype, delta in PACKED_COLUMNS:
+        events[name] = decode_column(bytes(row[name]), dtype, delta)
+    return events
+
+
+def packed_size(row):
+    """
+    Returns the bytes of the packed columns of a RunEvents row
+    """
+    return sum(len(row[name]) for name, dtype, delta in PACKED_COLUMNS)
+
+
+def insert_packed_runs(df, batch_size=100, max_bytes=2**21):
+    """
+    Inserts the events of the dataframe as one RunEvents row per run, with up to batch_size runs per insert statement
+
+    @max_bytes limit of the packed columns of one statement, so it stays below max_allowed_packet of MySQL,
+        4 MB by default, even when escaping doubles the blobs. A larger run is inserted on its own
+    """
+    rows = [
+        pack_run(night, runId, events)
+        for (night, runId), events in df.groupby(['night', 'runId'], sort=True)
+    ]
+    batch_size = max_rows_per_statement(batch_size, len(rows[0]) if rows else 1)
+    batch = []
+    batchBytes = 0
+    for row in rows:
+        size = packed_size(row)
+        if batch and (len(batch) >= batch_size or batchBytes + size > max_bytes):
+            RunEvents.insert_many(batch).execute()
+            batch = []
+            batchBytes = 0
+        batch.append(row)
+        batchBytes += size
+    if batch:
+        RunEvents.insert_many(batch).execute()
+    log.debug("Inserted {} events packed into {} runs".format(len(df), len(rows)))
@@ -1,10 +1,24 @@
 
+import logging
 import os
+import re
 import subprocess as sp
 import pandas as pd
+from functools import lru_cache
 
 import xmltodict
 
+log = logging.getLogger(__name__)
+
+# option to submit an array job, torque based PBS systems use '-t' instead of '-J'
+ARRAY_FLAGS = {'SGE': '-t', 'PBS': '-J'}
+# placeholder for the task index in the log paths of array jobs
+ARRAY_TASK_PLACEHOLDERS = {'SGE': '$TASK_ID', 'PBS': '^array_index^'}
+# environment variables holding the task index inside an array job
+ARRAY_TASK_ID_VARIABLES = ['SGE_TASK_ID', 'PBS_ARRAY_INDEX', 'PBS_ARRAYID']
+# next smaller unit of the memory units of SGE and PBS
+SMALLER_MEMORY_UNITS = {'t': 'g', 'g': 'm', 'm': 'k', 'k': '', 'tb': 'gb', 'gb': 'mb', 'mb': 'kb', 'kb': 'b'}
+
 def build_qsub_command(
         executable,
         stdout = None,
@@ -16,9 +30,17 @@ def build_qsub_command(
         environment = None,
         resources = None,
         engine = 'SGE',
+        array_size = None,
+        array_flag = None,
+        slots = None,
+        parallel_environment = 'smp',
         ):
     """
     Creates a qsub command, with all the different options
+
+    @array_size submit an array job with this amount of tasks, numbered from 1
+    @array_flag the qsub option for array jobs, defaults to the one of the engine
+    @slots the amount of cores of the job, SGE requests them from the parallel_environment
     """
     command = []
     command.append('qsub')
@@ -51,6 +73,12 @@ def build_qsub_command(
             for k, v in environment.items()
         ))
 
+    if slots and slots > 1:
+        if engine == 'SGE':
+            command.extend(['-pe', parallel_environment, str(slots)])
+        else:
+            resources = dict(resources or {}, nodes='1:ppn={}'.format(slots))
+
     if resources:
         command.append('-l')
         command.append(','.join(
@@ -58,6 +86,9 @@ def build_qsub_command(
             for k, v in resources.items()
         ))
 
+    if array_size:
+        command.extend([array_flag or ARRAY_FLAGS[engine], '1-{}'.format(array_size)])
+
     command.append(executable)
 
     return command
@@ -144,6 +175,86 @@ def get_current_jobs(engine='SGE'):
     raise NotImplementedError("Engine "+engine+" not supported")
 
 
+@lru_cache()
+def get_executable(name='el_generate_index_from_file'):
+    """
+    Returns the full path of the executable, it is only looked up once
+    """
+    return sp.check_output(['which', name]).decode().strip()
+
+
+def get_array_task_id():
+    """
+    Returns the index of the task inside an array job or None if not running in an array job
+    """
+    for variable in ARRAY_TASK_ID_VARIABLES:
+        taskId = os.environ.get(variable, '')
+        if taskId.isdigit():
+            return int(taskId)
+    return None
+
+
+def walltime_seconds(walltime):
+    """
+    Returns the walltime in seconds, given as [[HH:]MM:]SS or as seconds.
+    yaml reads unquoted values like 12:00:00 as seconds already
+    """
+    if isinstance(walltime, (int, float)):
+        return int(walltime)
+    seconds = 0
+    for part in str(walltime).strip().split(':'):
+        seconds = seconds*60 + int(part)
+    return seconds
+
+
+def scale_walltime(walltime, factor):
+    """
+    Returns the walltime multiplied by factor as HH:MM:SS, the walltime is unchanged if it can't be parsed
+    """
+    try:
+        total = walltime_seconds(walltime) * factor
+    except ValueError:
+        log.warning("Can't parse the walltime '{}', it is not scaled".format(walltime))
+        return walltime
+    return '{:02d}:{:02d}:{:02d}'.format(total // 3600, total // 60 % 60, total % 60)
+
+
+def scale_memory(memory, factor):
+    """
+    Returns the memory, given as amount with unit like 1gb or 1.5gb, multiplied by factor.
+    Fractional results are given in the next smaller units, as the batch systems only take whole amounts,
+    the memory is unchanged if it can't be parsed
+    """
+    match = re.match(r'^(\d+(?:\.\d*)?)\s*([a-zA-Z]*)$', str(memory).strip())
+    if match is None:
+        log.warning("Can't parse the memory '{}', it is not scaled".format(memory))
+        return memory
+    amount = float(match.group(1)) * factor
+    unit = match.group(2)
+    while amount != int(amount) and unit.lower() in SMALLER_MEMORY_UNITS:
+        amount *= 1024
+        smaller = SMALLER_MEMORY_UNITS[unit.lower()]
+        unit = smaller.upper() if unit.isupper() else smaller
+    return '{}{}'.format(int(round(amount)), unit)
+
+
+def array_task_resources(res, files_per_task, jobs_per_task=1, task_walltime=None):
+    """
+    Returns the resources of an array task processing files_per_task files with jobs_per_task workers
+    and the amount of cores it needs. The walltime of a single file is multiplied by the files each worker
+    processes, unless task_walltime is given. vmem is requested for all workers, pmem stays per process.
+    """
+    workers = max(1, min(jobs_per_task, files_per_task))
+    res = dict(res)
+    if task_walltime:
+        res['walltime'] = task_walltime
+    else:
+        res['walltime'] = scale_walltime(res['walltime'], (files_per_task + workers - 1) // workers)
+    if 'vmem' in res:
+        res['vmem'] = scale_memory(res['vmem'], workers)
+    return res, workers
+
+
 def create_qsub(file, log_dir, env, res,  kwargs):
     """
     Creates a new qsub to process a single file into the eventlist database
@@ -151,13 +262,9 @@ def create_qsub(file, log_dir, env, res,  kwargs):
     
     basename = os.path.basename(file)
     
-    executable = sp.check_output(
-        ['which', 'el_generate_index_from_file']
-    ).decode().strip()
-    
     env["FILE"] = file
     command = build_qsub_command(
-        executable  = executable,
+        executable  = get_executable(),
         job_name    = "eventlist_"+basename,
         environment = env,
         resources   = res, 
@@ -167,3 +274,30 @@ def create_qsub(file, log_dir, env, res,  kwargs):
     )
 
     return command
+
+
+def create_array_qsub(manifest, num_tasks, files_per_task, log_dir, env, res, kwargs, task_walltime=None):
+    """
+    Creates a new qsub for an array job processing all files of the manifest,
+    each task processes its slice of files_per_task files. The job is named after the manifest.
+    The resources are those of a single file, see array_task_resources for the ones of a task.
+    """
+    job_name = os.path.splitext(os.path.basename(manifest))[0]
+    placeholder = ARRAY_TASK_PLACEHOLDERS[kwargs.get('engine', 'SGE')]
+
+    env = dict(env, MANIFEST=manifest, FILES_PER_TASK=files_per_task)
+    res, slots = array_task_resources(res, files_per_task, int(env.get('JOBS', 1)), task_walltime)
+    env['WALLTIME'] = res['walltime']
+    command = build_qsub_command(
+        executable  = get_executable(),
+        job_name    = job_name,
+        environment = env,
+        resources   = res,
+        stdout      = os.path.join(log_dir, '{}.{}.o'.format(job_name, placeholder)),
+        stderr      = os.path.join(log_dir, '{}.{}.e'.format(job_name, placeholder)),
+        array_size  = num_tasks,
+        slots       = slots,
+        **kwargs,
+    )
+
+    return command
@@ -0,0 +1,109 @@
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import load_json_state, save_json_state
+
+log = logging.getLogger(__name__)
+
+# raw data files are named YYYYMMDD_RRR.fits.fz or .fits.gz, drs files and others don't match
+RAW_FILE_PATTERN = re.compile(r'^(\d{8})_(\d{3})\.fits\.([fg]z)$')
+
+
+def parseRawFilename(name):
+    """
+    Returns night, runId and extension of a raw data file name or None if it isn't one
+    """
+    match = RAW_FILE_PATTERN.match(name)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2)), match.group(3)
+
+
+def listDayDirectory(path):
+    """
+    Lists the raw data files of one YYYY/MM/DD directory as [night, runId, extension] entries
+    """
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            parsed = parseRawFilename(entry.name)
+            if parsed is not None:
+                files.append(list(parsed))
+    return files
+
+
+def listSubdirectories(path, digits):
+    """
+    Returns the names of the subdirectories of path consisting of the given amount of digits, sorted
+    """
+    with os.scandir(path) as entries:
+        return sorted(
+            entry.name for entry in entries
+            if len(entry.name) == digits and entry.name.isdigit() and entry.is_dir()
+        )
+
+
+def dayDirectories(rawfolder):
+    """
+    Returns the YYYY/MM/DD directories of the raw folder relative to it
+    """
+    days = []
+    for year in listSubdirectories(rawfolder, 4):
+        for month in listSubdirectories(os.path.join(rawfolder, year), 2):
+            for day in listSubdirectories(os.path.join(rawfolder, year, month), 2):
+                days.append('/'.join([year, month, day]))
+    return days
+
+
+def nightDirectory(rawfolder, night):
+    """
+    Returns the YYYY/MM/DD directory of the night in the raw folder
+    """
+    night = str(night)
+    return os.path.join(rawfolder, night[:4], night[4:6], night[6:8])
+
+
+def listNight(rawfolder, night):
+    """
+    Lists the raw data files of the night with one directory listing,
+    returns a dict runId -> extension where fz is preferred over gz
+    """
+    path = nightDirectory(rawfolder, night)
+    if not os.path.isdir(path):
+        return {}
+    runs = {}
+    for fileNight, runId, ext in listDayDirectory(path):
+        if fileNight == int(night) and runs.get(runId) != 'fz':
+            runs[runId] = ext
+    return runs
+
+
+def scanRawFolder(rawfolder, cache_file=None, threads=16):
+    """
+    Returns (night, runId, extension) of all raw data files in the YYYY/MM/DD tree of the raw folder
+
+    The day directories are listed on a thread pool. With a cache_file the listings are cached by the
+    modification time of their directory, so only directories that changed since the last scan are listed again.
+    """
+    cache = load_json_state(cache_file, {})
+    days = dayDirectories(rawfolder)
+
+    def scanDay(day):
+        path = os.path.join(rawfolder, day)
+        mtime = os.stat(path).st_mtime_ns
+        cached = cache.get(day)
+        if cached is not None and cached['mtime'] == mtime:
+            return day, cached, False
+        return day, {'mtime': mtime, 'files': listDayDirectory(path)}, True
+
+    with ThreadPoolExecutor(threads) as executor:
+        listings = list(executor.map(scanDay, days))
+    log.info("Scanned {} day directories, listed {} of them".format(
+        len(listings), sum(listed for day, listing, listed in listings)))
+
+    if cache_file is not None:
+        save_json_state(cache_file, {day: listing for day, listing, listed in listings})
+
+    return [tuple(f) for day, listing, listed in listings for f in listing['files']]
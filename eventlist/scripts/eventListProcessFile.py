@@ -1,57 +1,156 @@
 import click
 
-from ..utils import load_config
-from ..data import process_data_file
+from ..utils import load_config, read_manifest, night_run_condition
+from ..data import process_data_file, save_eventlist, EVENTLIST_FORMATS
+from ..qsub import get_array_task_id
+from ..bulk import insert_events
+from ..summary import insert_run_summaries
 
 from eventlist.model import *
 from fact.path import parse
 import logging
 import os
 import sys
+import pandas as pd
+from functools import partial
+from multiprocessing import Pool
 
 logger = logging.getLogger('EventList_File')
 logger.setLevel(logging.DEBUG)
 logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
 
-def write_eventlist_into_database(path, night, runId, ignore_db, df):
+def write_eventlist_into_database(path, night, runId, ignore_db, df, loader=None):
     """
-    Writes the data into the eventlist database and updates the processing database
+    Writes the data into the eventlist database and updates the processing database,
+    returns True if the events were inserted
+
+    @loader the settings for the bulk insert of the events, see insert_events
+    """
+    inserted = write_eventlists_into_database([(path, night, runId, df)], ignore_db, loader)
+    return len(inserted) != 0
+
+
+def write_eventlists_into_database(runs, ignore_db, loader=None):
+    """
+    Writes the data of several runs in one transaction into the eventlist database, together with
+    their run summaries, and updates their entries in the processing database with a single statement
+
+    @runs list of (path, night, runId, df) tuples
+    Returns the (night, runId) pairs of the runs whose events were inserted
     """
+    if len(runs) == 0:
+        return []
+
     with processing_db.atomic():
-        fileInfo = None
-        try:
-            fileInfo = ProcessingInfo.get((ProcessingInfo.night == night) & (ProcessingInfo.runId == runId))
-        except pew.DoesNotExist:
-            if not ignore_db:
-                logger.error("The entry for the file is missing in the processing database")
-                return
-            else:
-                logger.info("The entry for the file is missing in the processing database, adding it.")
-                ext = os.path.splitext(path)[1][1:]
-                fileInfo = ProcessingInfo.create(night=night, runId=runId, extension=ext, status=0)#, isdc=False, fhgfs=False,  bigtank=False)
-
-        if fileInfo.status==1:
-            logger.error("File is already processed, have you started the processing twice on this file?")
-            return
-        
+        pairs = [(night, runId) for path, night, runId, df in runs]
+        query = (ProcessingInfo.select(ProcessingInfo.night, ProcessingInfo.runId, ProcessingInfo.status)
+            .where(night_run_condition(ProcessingInfo.night, ProcessingInfo.runId, pairs))
+        )
+        status = {(night, runId): s for night, runId, s in query.tuples()}
+
+        inserted = []
+        for path, night, runId, df in runs:
+            if (night, runId) not in status:
+                if not ignore_db:
+                    logger.error("The entry for the file {}_{:03d} is missing in the processing database".format(night, runId))
+                    continue
+                else:
+                    logger.info("The entry for the file {}_{:03d} is missing in the processing database, adding it.".format(night, runId))
+                    ext = os.path.splitext(path)[1][1:]
+                    ProcessingInfo.create(night=night, runId=runId, extension=ext, status=0)#, isdc=False, fhgfs=False,  bigtank=False)
+            elif status[(night, runId)] == ProcessStatus.processed.value:
+                logger.error("File {}_{:03d} is already processed, have you started the processing twice on this file?".format(night, runId))
+                continue
+            inserted.append(((night, runId), df))
+
+        if len(inserted) == 0:
+            return []
+
         logger.debug("Insert Data")
-        Event.insert_many(df.to_dict(orient='records')).execute()
-        
+        events = pd.concat([df for key, df in inserted], ignore_index=True)
+        insert_events(events, **(loader or {}))
+        insert_run_summaries(events)
+
         logger.debug("Update processing db")
-        fileInfo.status = 1
-        fileInfo.save()
+        keys = [key for key, df in inserted]
+        (ProcessingInfo.update(status=ProcessStatus.processed.value)
+            .where(night_run_condition(ProcessingInfo.night, ProcessingInfo.runId, keys))
+            .execute())
+    return keys
 
 
-def write_eventlist_into_file(path, night, runId, ignore_db, df, output_folder):
+def write_eventlist_into_file(path, night, runId, ignore_db, df, output_folder, out_format='csv'):
     """
-    Writes the event data into a file
+    Writes the event data into a file, either a csv file or a binary npy file
     """
     filename = os.path.basename(path)
     
-    output_path = os.path.join(output_folder, filename+".csv")
+    output_path = os.path.join(output_folder, filename+"."+out_format)
     
-    df.to_csv(output_path, index=False)
+    save_eventlist(df, output_path)
+
+def set_processing_status(night, runId, status):
+    """
+    Sets the status of the file in the processing database
+    """
+    (ProcessingInfo.update(status=status.value)
+        .where(ProcessingInfo.night == night)
+        .where(ProcessingInfo.runId == runId)
+        .execute())
+
+
+def process_file(file, ignore_db, output_folder=None, loader=None, out_format='csv'):
+    """
+    Processes a single file into the EventList db, or into a csv or npy file if an output folder is given.
+    When writing into the db, failures are marked in the processing database.
+    Returns the file and whether it was processed successfully.
+    """
+    logger.info("Processing file: '"+file+"'")
+
+    night = None
+    try:
+        basename = os.path.basename(file)
+        fileDict = parse(file)
+        night = fileDict['night']
+        runId = fileDict['run']
+        logger.info("Basename: {}, Night: {}, runId: {}".format(basename, night, runId))
+
+        if not os.path.exists(file):
+            logger.error("File does not exists")
+            success = False
+        else:
+            logger.info("Start processing data file.")
+            df = process_data_file(file)
+            if df is None:
+                logger.error("Couldn't process data file")
+                success = False
+            elif output_folder is None:
+                logger.info("Fill into database")
+                return file, write_eventlist_into_database(file, night, runId, ignore_db, df, loader)
+            else:
+                logger.info("Write data into folder: "+output_folder)
+                write_eventlist_into_file(file, night, runId, ignore_db, df, output_folder, out_format)
+                success = True
+    except Exception:
+        logger.exception("Processing of file '{}' failed".format(file))
+        success = False
+
+    if not success and output_folder is None and night is not None:
+        try:
+            set_processing_status(night, runId, ProcessStatus.error)
+        except Exception:
+            logger.exception("Couldn't set the error status of file '{}'".format(file))
+    return file, success
+
+
+def init_worker(dbconfig):
+    """
+    Opens the processing db connection of a worker process, it is shared by all its files
+    """
+    if dbconfig is not None:
+        connect_processing_db(dbconfig)
+
 
 @click.command()
 @click.option(
@@ -61,45 +160,64 @@ def write_eventlist_into_file(path, night, runId, ignore_db, df, output_folder):
 @click.option('--file', default=None, envvar='FILE',
     type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True)
 )
+@click.option('--manifest', default=None, envvar='MANIFEST', help="File listing the data files to process, one path per line",
+    type=click.Path(exists=True, dir_okay=False, file_okay=True, readable=True)
+)
+@click.option('--jobs', '-j', default=1, envvar='JOBS', type=int, help="Amount of worker processes used for the files of the manifest")
+@click.option('--files_per_task', default=None, envvar='FILES_PER_TASK', type=int,
+    help="Inside an array job only process the slice of the manifest belonging to the task, this many files per task"
+)
 @click.option('--ignore_db', is_flag=True, help="If given, ignore if the file is missing from the processing db and just add it")
 @click.option('--out_file', envvar='OUT_FILE', default = None, help="If given wirte into a file in the data directory, given in the config (submitter.data_directory)")
-def eventListProcessFile(config, file, ignore_db, out_file):
+@click.option('--out_format', envvar='OUT_FORMAT', default='csv', type=click.Choice(EVENTLIST_FORMATS),
+    help="Format of the written file, csv or the compact binary npy format"
+)
+def eventListProcessFile(config, file, manifest, jobs, files_per_task, ignore_db, out_file, out_format):
     """
-    Processes a file into the EventList db or into a csv file
+    Processes a file or all files of a manifest into the EventList db or into csv files,
+    exits with status 1 if any of the files failed
     """
     logger.info("Loading config")
     if not config:
         logger.error("No config specified, can't work without it")
         return
     config, configpath = load_config(config)
-    
-    logger.info("Processing file: '"+file+"'")
 
-    if not os.path.exists(file):
-        logger.error("File does not exists")
+    files = []
+    if file is not None:
+        files.append(file)
+    if manifest is not None:
+        manifestFiles = read_manifest(manifest)
+        taskId = get_array_task_id()
+        if files_per_task and taskId is not None:
+            # array task ids start at 1
+            manifestFiles = manifestFiles[(taskId-1)*files_per_task:taskId*files_per_task]
+            logger.info("Array task {} processes {} files of the manifest".format(taskId, len(manifestFiles)))
+        files.extend(manifestFiles)
+    if len(files) == 0:
+        logger.error("Neither a file nor a manifest given")
         return
 
-    basename = os.path.basename(file)
-    fileDict = parse(file)
-    night = fileDict['night']
-    runId = fileDict['run']
-    logger.info("Basename: {}, Night: {}, runId: {}".format(basename, night, runId))
-
-    logger.info("Start processing data file.")
-    df = None
-    df = process_data_file(file)
-
-    if df is None:
-        logger.error("Couldn't process data file")
-        return
+    dbconfig = None
+    output_folder = None
     if out_file is None:
-        logger.info("Fill into database")
-        dbconfig  = config['processing_database']
-        connect_processing_db(dbconfig)
-        write_eventlist_into_database(file, night, runId, ignore_db, df)
+        dbconfig = config['processing_database']
     else:
-        logger.info("Write data into file: "+out_file)
         output_folder = os.path.join(config['submitter']['data_directory'], "output")
-        write_eventlist_into_file(file, night, runId, ignore_db, df, output_folder)
 
-    logger.info("Finished Processing")    
+    process = partial(process_file, ignore_db=ignore_db, output_folder=output_folder,
+        loader=config.get('loader'), out_format=out_format)
+    if jobs > 1 and len(files) > 1:
+        logger.info("Processing {} files with {} workers".format(len(files), jobs))
+        with Pool(jobs, initializer=init_worker, initargs=(dbconfig,)) as pool:
+            results = list(pool.imap_unordered(process, files))
+    else:
+        init_worker(dbconfig)
+        results = [process(f) for f in files]
+
+    failed = [f for f, success in results if not success]
+    for f in failed:
+        logger.error("Failed to process: '{}'".format(f))
+    logger.info("Finished Processing, {} of {} files successful".format(len(files)-len(failed), len(files)))
+    if failed:
+        sys.exit(1)
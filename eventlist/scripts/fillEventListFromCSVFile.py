@@ -1,9 +1,13 @@
 import click
 
 from ..utils import load_config
-from eventlist.scripts.eventListProcessFile import write_eventlist_into_database
+from eventlist.scripts.eventListProcessFile import write_eventlists_into_database, set_processing_status
+from ..data import load_eventlist
 
 from eventlist.model import *
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
 import logging
 import os
 
@@ -11,16 +15,64 @@ logger = logging.getLogger('EventList_CSVFile')
 logger.setLevel(logging.DEBUG)
 #logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
+
+def read_eventlist_file(path):
+    """
+    Reads the eventlist of a run from the csv or npy file and checks it for duplicated events
+    Returns the path, night, runId, the dataframe and whether it contains duplicates
+    """
+    df = load_eventlist(path)
+    basename = os.path.basename(path)
+    basename = os.path.splitext(basename)[0] # remove .csv or .npy
+
+    night = int(basename[:8])
+    runId = int(basename[9:12])
+
+    duplicates = df.duplicated(['night','runId','eventNr']).any()
+    return path, night, runId, df, duplicates
+
+
+def read_ahead(files, threads, queue_size):
+    """
+    Reads the files on a thread pool and yields them in order,
+    at most queue_size files are read ahead of the consumer
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        queue = deque()
+        for path in files:
+            if len(queue) >= queue_size:
+                yield queue.popleft().result()
+            queue.append(executor.submit(read_eventlist_file, path))
+        while queue:
+            yield queue.popleft().result()
+
+
+def insert_runs(runs, ignore_db, loader):
+    """
+    Writes the runs in one transaction into the database and removes their files
+    """
+    inserted = write_eventlists_into_database(
+        [(basename, night, runId, df) for path, basename, night, runId, df in runs], ignore_db, loader)
+    logger.info("Inserted {} of {} runs".format(len(inserted), len(runs)))
+
+    logger.debug("Removing files")
+    for path, basename, night, runId, df in runs:
+        os.remove(path)
+
+
 @click.command()
 @click.option(
     '--config', '-c', envvar='EVENTLIST_CONFIG',
     help='Config file, if not given, env EVENTLIST_CONFIG and ./eventlist.yaml will be tried'
 )
 @click.option('--ignore_db', is_flag=True, help="If given, ignore if the file is missing from the processing db and just add it")
+@click.option('--threads', default=4, type=int, help="Amount of threads reading the files")
+@click.option('--queue_size', default=16, type=int, help="Maximum amount of files read ahead of the database inserts")
+@click.option('--runs_per_transaction', default=20, type=int, help="Amount of runs inserted together in one transaction")
 @click.argument('datafolder', type=click.Path(exists=True, dir_okay=True, file_okay=False, readable=True))
-def updateEventListFromCSVFile(config, ignore_db, datafolder):
+def updateEventListFromCSVFile(config, ignore_db, threads, queue_size, runs_per_transaction, datafolder):
     """
-    Adds events into the eventlist database from a csv file
+    Adds events into the eventlist database from csv or npy files
     """
     logger.info("Loading config")
     if not config:
@@ -30,36 +82,30 @@ def updateEventListFromCSVFile(config, ignore_db, datafolder):
 
     logger.info("Connectiong to processing db")
     dbconfig = config['processing_database']
-    connect_processing_db(**dbconfig)
-    
-    logger.debug("Get all CSV-Files")
-    files = glob.glob(datafolder+"/*.csv")
-    
-    logger.info("Processing {} csv-files".format(len(files)))
-    for path in files:
+    connect_processing_db(dbconfig)
+
+    logger.debug("Get all CSV- and NPY-Files")
+    files = sorted(glob(os.path.join(datafolder, "*.csv")) + glob(os.path.join(datafolder, "*.npy")))
+
+    logger.info("Processing {} files".format(len(files)))
+    runs = []
+    for path, night, runId, df, duplicates in read_ahead(files, threads, queue_size):
         logger.info("Process file: {}".format(path))
-        df = pd.read_csv(path, index_col=False)
-        basename = os.path.basename(path)
-        basename = os.path.splitext(basename)[0] # remove .csv
-        
-        night = int(basename[:8])
-        runId = int(basename[9:12])
-
-        duplicates = df.duplicated(['night','runId','eventNr']).any()
         if duplicates:
             logger.info("An entry exists twice")
             logger.info("Set as error status and rename csv file")
-            info = ProcessingInfo.get((ProcessingInfo.night==night)&(ProcessingInfo.runId==runId))
-            info.status=2
-            info.save()
+            set_processing_status(night, runId, ProcessStatus.error)
             os.rename(path, path+".dup")
             continue
-        
-        logger.debug("Write events into database")
-        write_eventlist_into_database(basename, night, runId, ignore_db, df)
-        
-        logger.debug("Removing file")
-        os.remove(path)
-        logger.info("  Finished File")
-    
+
+        basename = os.path.splitext(os.path.basename(path))[0]
+        runs.append((path, basename, night, runId, df))
+        if len(runs) >= runs_per_transaction:
+            logger.debug("Write events into database")
+            insert_runs(runs, ignore_db, config.get('loader'))
+            runs = []
+
+    if runs:
+        insert_runs(runs, ignore_db, config.get('loader'))
+
     logger.info("Finished inserting eventlist data from files")
@@ -1,16 +1,14 @@
 
 
 from eventlist.model import *
-from eventlist.utils import load_config
+from eventlist.model import max_rows_per_statement
+from eventlist.utils import load_config, night_run_condition
+from eventlist.rawfolder import scanRawFolder
 import click
 
-from glob import glob
-
 import logging
 #import sys
 
-from fact.path import parse
-
 logger = logging.getLogger('updateEventlistFSStatus')
 logger.setLevel(logging.DEBUG)
 #logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
@@ -21,12 +19,20 @@ def nightRunIdToInt(night, runId):
     creates a unique id for every night runId combo of the type night*1000+runid
     """
     return night*1000+runId
-    
-def pathDictToInt(pathDict):
+
+
+def setAvailability(fs, runs, available, runs_per_update=1000):
     """
-    Converts the path dict from the parse pyfact function into a unique number
+    Sets the availability column of the filesystem for the given (night, runId) pairs,
+    runs_per_update runs are updated with one statement
     """
-    return nightRunIdToInt(pathDict['night'], pathDict['run'])
+    runs = sorted(runs)
+    runs_per_update = max_rows_per_statement(runs_per_update, 2)
+    for start in range(0, len(runs), runs_per_update):
+        chunk = runs[start:start+runs_per_update]
+        (ProcessingInfo.update(**{fs: available})
+            .where(night_run_condition(ProcessingInfo.night, ProcessingInfo.runId, chunk))
+            .execute())
 
 
 
@@ -37,7 +43,9 @@ def pathDictToInt(pathDict):
     '--config', '-c', envvar='EVENTLIST_CONFIG',
     help='Config file, if not given, env EVENTLIST_CONFIG and ./eventlist.yaml will be tried'
 )
-def updateEventlistFSStatus(rawfolder, config, fs):
+@click.option('--cache', type=click.Path(dir_okay=False), help='File caching the directory listings, only changed day directories are listed again')
+@click.option('--threads', default=16, type=int, help='Amount of threads listing the day directories')
+def updateEventlistFSStatus(rawfolder, config, fs, cache, threads):
     """
     Given the datafolder update the given filesystem column in the Processing DB
     Make sure to use the appropriate rawfolder for the filesystem 
@@ -54,27 +62,27 @@ def updateEventlistFSStatus(rawfolder, config, fs):
     dbconfig  = config['processing_database']
     connect_processing_db(dbconfig)
 
-    # glob all files from the raw folder and create a set of all the existing files
+    # scan all files from the raw folder and create a set of all the existing files
     logger.info("Searching for files in: {}".format(rawfolder))
-    filesGlob = glob(rawfolder+"/*/*/*/*.fits.?z")
-    logger.info("Found {} files.".format(len(filesGlob)))
-    fileSet = set([pathDictToInt(parse(x)) for x in filesGlob])
-    
-    query = (ProcessingInfo.select())
+    files = scanRawFolder(rawfolder, cache, threads)
+    logger.info("Found {} files.".format(len(files)))
+    fileSet = set([nightRunIdToInt(night, runId) for night, runId, ext in files])
     
     logger.info("Reprocessing the Eventlist database for the availibility in: {}".format(fs))
-    for procInfo in query:
-        night = procInfo.night
-        runId = procInfo.runId
-        id = nightRunIdToInt(night, runId)
-        # file doesn't exist anymore
-        if id not in fileSet and getattr(procInfo, fs):
-            setattr(procInfo,  fs,  0)
-            procInfo.save()
-        # file apeared again
-        elif id in fileSet and not getattr(procInfo, fs):
-            setattr(procInfo,  fs,  1)
-            procInfo.save()
-        # status of file unchanged, do nothing
-    logger.info("Finisehd updating the availibility of files.")
+    query = ProcessingInfo.select(ProcessingInfo.night, ProcessingInfo.runId, getattr(ProcessingInfo, fs)).tuples()
     
+    # only the runs whose availability changed need an update
+    newlyMissing = []
+    newlyPresent = []
+    for night, runId, available in list(query):
+        exists = nightRunIdToInt(night, runId) in fileSet
+        if available and not exists:
+            newlyMissing.append((night, runId))
+        elif exists and not available:
+            newlyPresent.append((night, runId))
+    logger.info("Files missing now: {}, files apeared again: {}".format(len(newlyMissing), len(newlyPresent)))
+    
+    with processing_db.atomic():
+        setAvailability(fs, newlyMissing, False)
+        setAvailability(fs, newlyPresent, True)
+    logger.info("Finisehd updating the availibility of files.")
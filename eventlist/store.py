@@ -0,0 +1,338 @@
+import click
+import logging
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime, timezone
+from glob import glob
+import numpy as np
+
+from .data import EVENTLIST_DTYPES, EVENT_DTYPE, load_eventlist
+from .model import Event, RunEvents, ProcessingInfo, ProcessStatus, connect_processing_db, processing_db, is_sqlite
+from .bulk import EVENT_COLUMNS, quote
+from .packed import unpack_run
+from .utils import load_config
+
+logger = logging.getLogger('EventList_Store')
+logger.setLevel(logging.DEBUG)
+logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+# the night is given by the directory, all other columns have their own file
+STORE_COLUMNS = [name for name, dtype in EVENTLIST_DTYPES if name != 'night']
+
+# sidecar files of every night with the event times in microseconds, sorted, and the rows in this order
+TIME_KEY = 'timeKey'
+TIME_ORDER = 'timeOrder'
+
+
+class EventStore:
+    """
+    Local copy of the eventlist, partitioned by night
+
+    Every night is a directory root/YYYYMMDD with one .npy file per column, sorted by runId and eventNr.
+    The columns are memory mapped when read, so only the pages of the needed columns and rows are touched.
+    Selections by night and runId only read the matching rows, found by binary search in the runId column.
+    Next to the columns every night has the sorted event times and the matching row order,
+    so the events of a time window are found by binary search as well.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def nightDirectory(self, night):
+        return os.path.join(self.root, str(int(night)))
+
+    def nights(self, firstnight=None, lastnight=None):
+        """
+        Returns the stored nights in the given range, sorted
+        """
+        if not os.path.isdir(self.root):
+            return []
+        nights = sorted(int(name) for name in os.listdir(self.root) if len(name) == 8 and name.isdigit())
+        return [
+            night for night in nights
+            if (firstnight is None or night >= firstnight) and (lastnight is None or night <= lastnight)
+        ]
+
+    def read_night(self, night, columns=None):
+        """
+        Returns a dict with the memory mapped columns of the night
+        """
+        columns = columns or STORE_COLUMNS
+        path = self.nightDirectory(night)
+        return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in columns}
+
+    def write_night(self, night, events):
+        """
+        Replaces the events of the night with the given structured array or dataframe.
+        The columns are written into a new directory which then replaces the old one
+        """
+        order = np.lexsort((np.asarray(events['eventNr']), np.asarray(events['runId'])))
+        path = self.nightDirectory(night)
+        tmpPath = path + '.tmp'
+        os.makedirs(tmpPath, exist_ok=True)
+        for name, dtype in EVENTLIST_DTYPES:
+            if name != 'night':
+                np.save(os.path.join(tmpPath, name + '.npy'), np.asarray(events[name])[order].astype(dtype))
+
+        time = timeKey(np.asarray(events['UTC'])[order], np.asarray(events['UTCus'])[order])
+        timeOrder = np.argsort(time, kind='stable')
+        np.save(os.path.join(tmpPath, TIME_KEY + '.npy'), time[timeOrder])
+        np.save(os.path.join(tmpPath, TIME_ORDER + '.npy'), timeOrder.astype(np.uint32 if len(time) < 2**32 else np.int64))
+
+        if os.path.exists(path):
+            oldPath = path + '.old'
+            os.rename(path, oldPath)
+            os.rename(tmpPath, path)
+            for name in os.listdir(oldPath):
+                os.remove(os.path.join(oldPath, name))
+            os.rmdir(oldPath)
+        else:
+            os.rename(tmpPath, path)
+
+    def read_time_index(self, night):
+        """
+        Returns the sorted event times and the matching row order of the night, memory mapped.
+        For nights written without them they are calculated from the columns
+        """
+        path = self.nightDirectory(night)
+        keyPath = os.path.join(path, TIME_KEY + '.npy')
+        if os.path.exists(keyPath):
+            return np.load(keyPath, mmap_mode='r'), np.load(os.path.join(path, TIME_ORDER + '.npy'), mmap_mode='r')
+        logger.debug("No time index for night {}, sorting the events".format(night))
+        data = self.read_night(night, ['UTC', 'UTCus'])
+        time = timeKey(data['UTC'], data['UTCus'])
+        timeOrder = np.argsort(time, kind='stable')
+        return time[timeOrder], timeOrder
+
+    def add_events(self, night, events):
+        """
+        Adds the events to the night, events already in the store are replaced by the given ones
+        """
+        events = np.asarray(toStructured(events), dtype=EVENT_DTYPE)
+        if night in self.nights(night, night):
+            old = self.select(night, night)
+            # keep the old events that are not part of the new ones
+            oldKeys = old['runId'].astype(np.int64) << 32 | old['eventNr']
+            newKeys = events['runId'].astype(np.int64) << 32 | events['eventNr']
+            events = np.concatenate([old[~np.isin(oldKeys, newKeys)], events])
+        self.write_night(night, events)
+
+    def runRange(self, runIdColumn, runIds):
+        """
+        Returns the row indices of the given runs in the sorted runId column
+        """
+        starts = np.searchsorted(runIdColumn, runIds, side='left')
+        stops = np.searchsorted(runIdColumn, runIds, side='right')
+        return np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops)] or [np.empty(0, dtype=np.int64)])
+
+    def iter_nights(self, firstnight=None, lastnight=None, runIds=None, event_types=None, columns=None):
+        """
+        Yields night and a dict with the selected columns of the selected events for every night.
+        Without a selection of runs or trigger types the columns are the memory mapped files themselves.
+
+        @runIds only the events of these runs
+        @event_types only the events of these trigger types
+        """
+        columns = columns or STORE_COLUMNS
+        for night in self.nights(firstnight, lastnight):
+            data = self.read_night(night, set(columns) | {'runId', 'eventType'})
+            rows = None
+            if runIds is not None:
+                rows = self.runRange(data['runId'], np.sort(np.asarray(runIds)))
+            if event_types is not None:
+                eventType = data['eventType'] if rows is None else data['eventType'][rows]
+                selected = np.isin(eventType, event_types)
+                rows = np.flatnonzero(selected) if rows is None else rows[selected]
+
+            if rows is None:
+                yield night, {name: data[name] for name in columns}
+            elif len(rows) > 0:
+                yield night, {name: data[name][rows] for name in columns}
+
+    def select(self, firstnight=None, lastnight=None, runIds=None, event_types=None):
+        """
+        Returns the selected events as one structured array, see iter_nights for the selection
+        """
+        parts = []
+        for night, data in self.iter_nights(firstnight, lastnight, runIds, event_types):
+            events = np.empty(len(data['runId']), dtype=EVENT_DTYPE)
+            events['night'] = night
+            for name in STORE_COLUMNS:
+                events[name] = data[name]
+            parts.append(events)
+        if not parts:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        return np.concatenate(parts)
+
+    def events_between(self, t0, t1, event_types=None):
+        """
+        Returns the events with t0 <= time < t1 as one structured array sorted by time.
+        Every night needs two binary searches in its sorted times and reads only the rows in the window.
+
+        @t0, t1 datetimes, naive ones are taken as UTC, or unix timestamps in seconds
+        @event_types only the events of these trigger types
+        """
+        start, stop = toMicroseconds(t0), toMicroseconds(t1)
+        # the events of a night are taken from its evening until the next morning,
+        # so the night before the day of t0 can have events in the window as well
+        firstnight = int(datetime.fromtimestamp(start // 1000000 - 86400, timezone.utc).strftime('%Y%m%d'))
+        lastnight = int(datetime.fromtimestamp(stop // 1000000, timezone.utc).strftime('%Y%m%d'))
+
+        parts = []
+        for night in self.nights(firstnight, lastnight):
+            time, timeOrder = self.read_time_index(night)
+            first, last = np.searchsorted(time, [start, stop], side='left')
+            if first == last:
+                continue
+            rows = np.asarray(timeOrder[first:last])
+            data = self.read_night(night)
+            if event_types is not None:
+                rows = rows[np.isin(data['eventType'][rows], event_types)]
+            events = np.empty(len(rows), dtype=EVENT_DTYPE)
+            events['night'] = night
+            for name in STORE_COLUMNS:
+                events[name] = data[name][rows]
+            parts.append(events)
+        if not parts:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        events = np.concatenate(parts)
+        if len(parts) > 1:
+            events = events[np.argsort(timeKey(events['UTC'], events['UTCus']), kind='stable')]
+        return events
+
+
+def timeKey(UTC, UTCus):
+    """
+    Returns the event times in microseconds since the epoch
+    """
+    return np.asarray(UTC).astype(np.int64) * 1000000 + np.asarray(UTCus).astype(np.int64)
+
+
+def toMicroseconds(t):
+    """
+    Converts a datetime, naive ones are taken as UTC, or a unix timestamp into microseconds since the epoch
+    """
+    if isinstance(t, datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        delta = t - datetime(1970, 1, 1, tzinfo=timezone.utc)
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return int(round(t * 1000000))
+
+
+def toStructured(events):
+    """
+    Converts an eventlist dataframe into a structured array, structured arrays are returned as they are
+    """
+    if isinstance(events, np.ndarray):
+        return events
+    result = np.empty(len(events), dtype=EVENT_DTYPE)
+    for name in EVENT_DTYPE.names:
+        result[name] = events[name].values
+    return result
+
+
+def fetchNight(night, batch_size=100000):
+    """
+    Reads the events of the night from the eventlist table with a cursor in batches of batch_size rows.
+    On MySQL the cursor is unbuffered, so the rows are streamed from the server instead of being
+    loaded into the client at once, sqlite cursors always step through the rows.
+    """
+    sql = "SELECT {} FROM {} WHERE {} = {}".format(
+        ', '.join(quote(c) for c in EVENT_COLUMNS), quote(Event._meta.db_table), quote('night'), processing_db.interpolation)
+    if is_sqlite():
+        cursor = processing_db.execute_sql(sql, [night])
+    else:
+        from pymysql.cursors import SSCursor
+        cursor = processing_db.get_conn().cursor(SSCursor)
+        cursor.execute(sql, [night])
+    parts = []
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            parts.append(np.array(rows, dtype=EVENT_DTYPE))
+    finally:
+        # an unbuffered cursor blocks the connection until it is closed
+        cursor.close()
+    return np.concatenate(parts) if parts else np.empty(0, dtype=EVENT_DTYPE)
+
+
+def fetchPackedNight(night):
+    """
+    Reads the runs of the night from the run packed table and decodes them
+    """
+    runs = [unpack_run(row) for row in RunEvents.select().where(RunEvents.night == night).order_by(RunEvents.runId)]
+    return np.concatenate(runs) if runs else np.empty(0, dtype=EVENT_DTYPE)
+
+
+def storeFromFiles(store, datafolder):
+    """
+    Adds the eventlists written by el_generate_index into the store, the files are kept
+    """
+    files = defaultdict(list)
+    for path in sorted(glob(os.path.join(datafolder, "*.csv")) + glob(os.path.join(datafolder, "*.npy"))):
+        files[int(os.path.basename(path)[:8])].append(path)
+
+    for night, paths in sorted(files.items()):
+        events = np.concatenate([toStructured(load_eventlist(path)) for path in paths])
+        logger.info("Adding {} events of {} runs of night {}".format(len(events), len(paths), night))
+        store.add_events(night, events)
+
+
+def storeFromDatabase(store, firstnight=None, lastnight=None):
+    """
+    Exports the eventlist night by night into the store, the events of both the Event table
+    and the run packed RunEvents table, runs found in both tables are taken from the Event table
+    """
+    query = ProcessingInfo.select(ProcessingInfo.night).distinct().where(ProcessingInfo.status == ProcessStatus.processed.value)
+    if firstnight is not None:
+        query = query.where(ProcessingInfo.night >= firstnight)
+    if lastnight is not None:
+        query = query.where(ProcessingInfo.night <= lastnight)
+    nights = sorted(night for night, in query.tuples())
+
+    for night in nights:
+        events = fetchNight(night)
+        packed = fetchPackedNight(night)
+        if len(packed) > 0:
+            packed = packed[~np.isin(packed['runId'], np.unique(events['runId']))]
+            events = np.concatenate([events, packed])
+        logger.info("Exporting {} events of night {}".format(len(events), night))
+        if len(events) > 0:
+            store.write_night(night, events)
+
+
+@click.command()
+@click.argument('root', type=click.Path(file_okay=False, dir_okay=True))
+@click.option(
+    '--config', '-c', envvar='EVENTLIST_CONFIG',
+    help='Config file, if not given, env EVENTLIST_CONFIG and ./eventlist.yaml will be tried'
+)
+@click.option('--datafolder', type=click.Path(exists=True, dir_okay=True, file_okay=False, readable=True),
+    help='Folder with csv or npy files of el_generate_index to add, if not given the eventlist database is exported')
+@click.option('--firstnight', '-f', type=int, help='First night to export')
+@click.option('--lastnight', '-l', type=int, help='Last night to export')
+def buildEventStore(root, config, datafolder, firstnight, lastnight):
+    """
+    Builds the local event store in ROOT from the eventlist database or the output files of el_generate_index
+    """
+    store = EventStore(root)
+    os.makedirs(root, exist_ok=True)
+
+    if datafolder is not None:
+        storeFromFiles(store, datafolder)
+        logger.info("Finished")
+        return
+
+    logger.info("Loading config")
+    if not config:
+        logger.error("No config specified, can't work without it")
+        return
+    config, configpath = load_config(config)
+
+    logger.info("Connecting to processing db")
+    connect_processing_db(config['processing_database'])
+    storeFromDatabase(store, firstnight, lastnight)
+    logger.info("Finished")
@@ -0,0 +1,89 @@
+import logging
+import numpy as np
+import pandas as pd
+
+from fact.instrument import trigger
+
+from .model import RunSummary, max_rows_per_statement
+
+log = logging.getLogger(__name__)
+
+# column of the RunSummary table counting the events of each trigger type,
+# all other trigger types are counted in numOther
+TRIGGER_COUNTS = [
+    ('numPhysics', trigger.PHYSICS),
+    ('numPedestal', trigger.PEDESTAL),
+    ('numLightPulserExt', trigger.LIGHT_PULSER_EXTERNAL),
+    ('numLightPulserInt', trigger.LIGHT_PULSER_INTERNAL),
+    ('numTimeCalibration', trigger.TIME_CALIBRATION),
+    ('numExt1', trigger.EXT1),
+    ('numExt2', trigger.EXT2),
+]
+
+SUMMARY_COLUMNS = (
+    ['night', 'runId', 'runType', 'numEvents']
+    + [name for name, value in TRIGGER_COUNTS]
+    + ['numOther', 'minEventNr', 'maxEventNr', 'firstUTC', 'firstUTCus', 'lastUTC', 'lastUTCus', 'numGaps']
+)
+
+
+def summarize_runs(df):
+    """
+    Returns a dataframe with one row per run of the eventlist dataframe with the columns of the RunSummary table
+    """
+    keys = ['night', 'runId']
+    df = df.sort_values(keys + ['eventNr'])
+    night = df['night'].values.astype(np.int64)
+    runId = df['runId'].values.astype(np.int64)
+    eventNr = df['eventNr'].values.astype(np.int64)
+    eventType = df['eventType'].values
+    # UTC and UTCus as one value to find the first and last event in time
+    time = df['UTC'].values.astype(np.int64) * 1000000 + df['UTCus'].values.astype(np.int64)
+
+    # a gap is a step of more than one in eventNr between two events of the same run
+    sameRun = (night[1:] == night[:-1]) & (runId[1:] == runId[:-1])
+    gap = np.zeros(len(df), dtype=np.int64)
+    gap[1:] = (np.diff(eventNr) > 1) & sameRun
+
+    columns = {
+        'night': night,
+        'runId': runId,
+        'runType': df['runType'].values,
+        'eventNr': eventNr,
+        'time': time,
+        'gap': gap,
+    }
+    for name, value in TRIGGER_COUNTS:
+        columns[name] = (eventType == value).astype(np.int64)
+
+    grouped = pd.DataFrame(columns).groupby(keys, sort=True)
+    summary = grouped.agg(
+        runType=('runType', 'first'),
+        numEvents=('eventNr', 'size'),
+        minEventNr=('eventNr', 'min'),
+        maxEventNr=('eventNr', 'max'),
+        first=('time', 'min'),
+        last=('time', 'max'),
+        numGaps=('gap', 'sum'),
+        **{name: (name, 'sum') for name, value in TRIGGER_COUNTS}
+    ).reset_index()
+
+    summary['numOther'] = summary['numEvents'] - summary[[name for name, value in TRIGGER_COUNTS]].sum(axis=1)
+    summary['firstUTC'], summary['firstUTCus'] = np.divmod(summary['first'].values, 1000000)
+    summary['lastUTC'], summary['lastUTCus'] = np.divmod(summary['last'].values, 1000000)
+    return summary[SUMMARY_COLUMNS].astype(np.int64)
+
+
+def insert_run_summaries(df, batch_size=1000):
+    """
+    Inserts the summaries of the runs of the eventlist dataframe into the RunSummary table
+    """
+    summary = summarize_runs(df)
+    rows = [
+        dict(zip(SUMMARY_COLUMNS, (int(v) for v in values)))
+        for values in summary.itertuples(index=False, name=None)
+    ]
+    batch_size = max_rows_per_statement(batch_size, len(SUMMARY_COLUMNS))
+    for start in range(0, len(rows), batch_size):
+        RunSummary.insert_many(rows[start:start+batch_size]).execute()
+    log.debug("Inserted the summaries of {} runs".format(len(rows)))
@@ -1,6 +1,9 @@
 import yaml
+import json
 import os
 import logging
+import operator
+from functools import reduce
 
 log = logging.getLogger(__name__)
 
@@ -27,3 +30,68 @@ def load_config(filename=None, environ_name='EVENTLIST_CONFIG'):
         config = yaml.safe_load(f)
 
     return config, os.path.abspath(filename)
+
+
+def read_manifest(manifest):
+    '''
+    Returns the files listed in the manifest, one path per line,
+    empty lines and lines starting with # are ignored
+    '''
+    with open(manifest) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def write_manifest(manifest, files):
+    '''
+    Writes the files into the manifest, one path per line
+    '''
+    with open(manifest, 'w') as f:
+        for path in files:
+            f.write(path + '\n')
+
+
+def load_json_state(path, default=None):
+    '''
+    Returns the content of the json file, default if no path is given or the file doesn't exist
+    '''
+    if path is None or not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json_state(path, state):
+    '''
+    Writes the state into the json file, the old file is only replaced once the new one is complete.
+    The directory of the file is created if it doesn't exist yet
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def night_run_condition(night_field, run_field, pairs, condition=None):
+    '''
+    Creates a peewee expression matching all the given (night, runId) pairs,
+    the runs are grouped by night into one IN list per night
+
+    @condition added to the expression of every night, so an index starting with its field
+        and continuing with night and runId can be used for all of them
+    '''
+    runsPerNight = {}
+    for night, runId in pairs:
+        runsPerNight.setdefault(int(night), []).append(int(runId))
+
+    conditions = [
+        (night_field == night) & (run_field << runIds)
+        for night, runIds in sorted(runsPerNight.items())
+    ]
+    if condition is not None:
+        conditions = [c & condition for c in conditions]
+    # combined pairwise, so the nesting only grows with the logarithm of the nights,
+    # a chain of one OR per night overflows the parser of sqlite after about 100 nights
+    while len(conditions) > 1:
+        conditions = [reduce(operator.or_, conditions[i:i+2]) for i in range(0, len(conditions), 2)]
+    return conditions[0]
@@ -17,7 +17,7 @@ setup(
     license = "GPL3",
     keywords = "fact database eventlist",
     url = "https://github.com/fact-project/eventlist",
-    packages=['eventlist'],
+    packages=['eventlist', 'eventlist.scripts'],
     #long_description=read('README'),
     install_requires=[
         'peewee==2.*',
@@ -35,8 +35,10 @@ setup(
             'el_generate_index_from_file = eventlist.scripts.eventListProcessFile:eventListProcessFile',
             'el_create_noise_db = eventlist.noiseDatabase:getNoiseDBcondition',
             'el_update_index = eventlist.database:processNewFiles',
-            'el_fill_index_from_csv = eventlist.database.scripts.updateEventListFromCSVFile:updateEventListFromCSVFile',
-            'el_update_processing_db_fs_status = eventlist.scripts.updateEventlistFSStatus:updateEventlistFSStatus'
+            'el_fill_index_from_csv = eventlist.scripts.fillEventListFromCSVFile:updateEventListFromCSVFile',
+            'el_update_processing_db_fs_status = eventlist.scripts.updateEventlistFSStatus:updateEventlistFSStatus',
+            'el_migrate_index = eventlist.migrations:migrateEventList',
+            'el_build_event_store = eventlist.store:buildEventStore',
         ],
     },
 )
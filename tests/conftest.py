@@ -0,0 +1,120 @@
+import struct
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+# processings of the zfits blocks, see read_zfits_columns
+RAW = 0
+HUFFMAN16 = 2
+
+
+def zfits_block(values, ordering, processings):
+    """
+    Returns a heap block: size, ordering, number of processings, the processings and the little endian values
+    """
+    if ordering == 'C':
+        values = values.T
+    payload = np.ascontiguousarray(values).astype(values.dtype.newbyteorder('<')).tobytes()
+    head = struct.pack('<QcB', 10 + 2*len(processings) + len(payload), ordering.encode(), len(processings))
+    return head + struct.pack('<{}H'.format(len(processings)), *processings) + payload
+
+
+def write_zfits(path, columns, tileLen, ordering='R', processings=None, header=None):
+    """
+    Writes a zfits table in the layout of the FACT raw data files: a catalog with the size and heap offset
+    of every block, followed by the heap with one tile header and one block per column for every tile
+
+    @columns list of (name, zform, 2d array with one row per event)
+    @processings dict column name -> processings of its blocks, the values are always written raw
+    """
+    processings = processings or {}
+    numRows = len(columns[0][2])
+    numTiles = (numRows + tileLen - 1) // tileLen
+
+    heap = b''
+    catalog = []
+    for tile in range(numTiles):
+        rows = slice(tile*tileLen, (tile+1)*tileLen)
+        tileRows = len(columns[0][2][rows])
+        blocks = [zfits_block(values[rows], ordering, processings.get(name, (RAW,))) for name, form, values in columns]
+        heap += b'TILE' + struct.pack('<IQ', tileRows, sum(len(b) for b in blocks))
+        entries = []
+        for block in blocks:
+            entries.append((len(block), len(heap)))
+            heap += block
+        catalog.append(entries)
+    catalog = np.array(catalog, dtype='>i8').tobytes()
+
+    h = fits.Header()
+    h['XTENSION'] = 'BINTABLE'
+    h['BITPIX'] = 8
+    h['NAXIS'] = 2
+    h['NAXIS1'] = 16 * len(columns)
+    h['NAXIS2'] = numTiles
+    h['PCOUNT'] = len(heap)
+    h['GCOUNT'] = 1
+    h['TFIELDS'] = len(columns)
+    for i, (name, form, values) in enumerate(columns):
+        h['TTYPE{}'.format(i+1)] = name
+        h['TFORM{}'.format(i+1)] = '1QB'
+        h['ZFORM{}'.format(i+1)] = form
+        h['ZCTYP{}'.format(i+1)] = 'FACT'
+    h['ZTABLE'] = True
+    h['ZNAXIS1'] = sum(values.dtype.itemsize * values.shape[1] for name, form, values in columns)
+    h['ZNAXIS2'] = numRows
+    h['ZTILELEN'] = tileLen
+    h['ZHEAPPTR'] = len(catalog)
+    h['ZSHRINK'] = 1
+    h['EXTNAME'] = 'Events'
+    for key, value in (header or {}).items():
+        h[key] = value
+
+    data = catalog + heap
+    data += b'\0' * ((2880 - len(data) % 2880) % 2880)
+    with open(path, 'wb') as f:
+        f.write(fits.PrimaryHDU().header.tostring().encode())
+        f.write(h.tostring().encode())
+        f.write(data)
+
+
+def fact_run(numEvents=1050, roi=10):
+    """
+    Returns the columns of a synthetic FACT run
+    """
+    events = np.arange(numEvents)
+    eventNr = (events + 1).astype(np.int32).reshape(-1, 1)
+    utc = np.stack([1500000000 + events // 80, (events * 12500) % 1000000], axis=1).astype(np.int32)
+    triggerType = np.where(events % 10 == 0, 1024, 4).astype(np.int16).reshape(-1, 1)
+    data = np.random.RandomState(0).randint(0, 1000, (numEvents, 1440*roi)).astype(np.int16)
+    return [
+        ('EventNum', '1J', eventNr),
+        ('TriggerType', '1I', triggerType),
+        ('UnixTimeUTC', '2J', utc),
+        ('Data', '{}I'.format(1440*roi), data),
+    ]
+
+
+RUN_HEADER = {'RUNTYPE': 'data', 'NIGHT': 20170101, 'RUNID': 42}
+
+
+@pytest.fixture(params=['R', 'C'])
+def zfits_run(request, tmpdir):
+    """
+    A small run as raw zfits file with row or column ordered blocks, the last tile isn't full
+    """
+    path = str(tmpdir.join('20170101_042.fits.fz'))
+    columns = fact_run()
+    write_zfits(path, columns, tileLen=100, ordering=request.param, header=RUN_HEADER)
+    return path, {name: values for name, form, values in columns}
+
+
+@pytest.fixture
+def compressed_zfits_run(tmpdir):
+    """
+    A run whose pixel data blocks are marked as huffman compressed
+    """
+    path = str(tmpdir.join('20170101_043.fits.fz'))
+    columns = fact_run(numEvents=250)
+    write_zfits(path, columns, tileLen=100, processings={'Data': (HUFFMAN16,)}, header=RUN_HEADER)
+    return path, {name: values for name, form, values in columns}
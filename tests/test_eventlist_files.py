@@ -0,0 +1,43 @@
+import numpy as np
+
+from eventlist.data import EVENTLIST_COLUMNS, EVENTLIST_DTYPES, create_eventlist, save_eventlist, load_eventlist
+
+
+def eventlist():
+    utc = np.stack([1500000000 + np.arange(100) // 10, np.arange(100) * 1000], axis=1)
+    eventType = np.where(np.arange(100) % 10 == 0, 1024, 4)
+    return create_eventlist(20170101, 42, 'data', np.arange(1, 101), utc, eventType)
+
+
+def test_npy_roundtrip(tmpdir):
+    df = eventlist()
+    path = str(tmpdir.join('20170101_042.fits.fz.npy'))
+    save_eventlist(df, path)
+    loaded = load_eventlist(path)
+
+    assert list(loaded.columns) == EVENTLIST_COLUMNS
+    assert [loaded[name].dtype for name in EVENTLIST_COLUMNS] == [np.dtype(dtype) for name, dtype in EVENTLIST_DTYPES]
+    np.testing.assert_array_equal(loaded.values, df.values)
+
+
+def test_npy_load_is_zero_copy(tmpdir):
+    path = str(tmpdir.join('20170101_042.fits.fz.npy'))
+    save_eventlist(eventlist(), path)
+    loaded = load_eventlist(path)
+
+    for name in EVENTLIST_COLUMNS:
+        # the column has to be a view into the memory map of the file
+        base = loaded[name].values
+        while base is not None and not isinstance(base, np.memmap):
+            base = base.base
+        assert base is not None
+
+
+def test_csv_roundtrip(tmpdir):
+    df = eventlist()
+    path = str(tmpdir.join('20170101_042.fits.fz.csv'))
+    save_eventlist(df, path)
+    loaded = load_eventlist(path)
+
+    assert [loaded[name].dtype for name in EVENTLIST_COLUMNS] == [np.dtype(dtype) for name, dtype in EVENTLIST_DTYPES]
+    np.testing.assert_array_equal(loaded.values, df.values)
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from eventlist.noiseDatabase import getClosestDrsFiles
+
+
+def closestDrsFilesOneByOne(drsFiles, night, startTime):
+    """
+    The former per run search of the closest two drs files of the night
+    """
+    nightFiles = drsFiles[drsFiles['NIGHT'] == night].reset_index(drop=True)
+    delta = np.abs(nightFiles['START'] - pd.Timestamp(startTime, unit='s'))
+    minIndex = np.argmin(delta.values)
+    if minIndex == len(nightFiles)-1:
+        secMinIndex = minIndex-1
+    elif minIndex == 0:
+        secMinIndex = 1
+    else:
+        secMinIndex = minIndex-1 if delta[minIndex-1] < delta[minIndex+1] else minIndex+1
+    return nightFiles['RUNID'][minIndex], nightFiles['RUNID'][secMinIndex]
+
+
+def random_night(rng, night, numDrs, numRuns):
+    """
+    Returns the drs files and runs of a night, the drs files start at even and the runs at odd seconds,
+    so no run is exactly between two drs files
+    """
+    evening = int(pd.Timestamp(str(night)).timestamp()) + 18*3600
+    drsStart = evening + 2*np.sort(rng.choice(6*3600, numDrs, replace=False))
+    drs = pd.DataFrame({
+        'NIGHT': night,
+        'RUNID': rng.choice(np.arange(1, 300), numDrs, replace=False),
+        'START': pd.to_datetime(drsStart, unit='s'),
+    })
+    runs = pd.DataFrame({
+        'night': night,
+        'runId': np.arange(1, numRuns + 1),
+        'UTC': evening - 1800 + 2*rng.randint(0, 7*3600, numRuns) + 1,
+    })
+    return drs, runs
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_closest_drs_files_match_former_search(seed):
+    rng = np.random.RandomState(seed)
+    nights = [random_night(rng, night, rng.randint(2, 8), 10) for night in [20170101, 20170102, 20170104]]
+    drsFiles = pd.concat([drs for drs, runs in nights]).sort_values(['NIGHT', 'START']).reset_index(drop=True)
+    runs = pd.concat([runs for drs, runs in nights]).reset_index(drop=True)
+
+    result = getClosestDrsFiles(drsFiles, runs)
+    assert len(result) == len(runs)
+    for night, runId, utc, drs0, drs1 in result[['night', 'runId', 'UTC', 'drs0', 'drs1']].itertuples(index=False):
+        assert (drs0, drs1) == closestDrsFilesOneByOne(drsFiles, night, utc), (night, runId)
+
+
+def test_closest_drs_files_single_and_missing():
+    rng = np.random.RandomState(1)
+    single, singleRuns = random_night(rng, 20170101, 1, 5)
+    several, severalRuns = random_night(rng, 20170102, 4, 5)
+    none, noneRuns = random_night(rng, 20170103, 0, 5)
+    drsFiles = pd.concat([single, several]).reset_index(drop=True)
+    runs = pd.concat([singleRuns, severalRuns, noneRuns]).reset_index(drop=True)
+
+    result = getClosestDrsFiles(drsFiles, runs)
+    # the only drs file of a night is used for both, runs of nights without drs files are dropped
+    assert list(result['night'].unique()) == [20170101, 20170102]
+    onlyDrs = single['RUNID'].iloc[0]
+    singleResult = result[result['night'] == 20170101]
+    assert (singleResult['drs0'] == onlyDrs).all() and (singleResult['drs1'] == onlyDrs).all()
+    for night, utc, drs0, drs1 in result[result['night'] == 20170102][['night', 'UTC', 'drs0', 'drs1']].itertuples(index=False):
+        assert (drs0, drs1) == closestDrsFilesOneByOne(drsFiles, night, utc)
+
+
+def test_closest_drs_files_without_drs_files():
+    rng = np.random.RandomState(2)
+    drs, runs = random_night(rng, 20170101, 0, 3)
+    result = getClosestDrsFiles(drs, runs)
+    assert len(result) == 0
+    assert {'drs0', 'drs1'} <= set(result.columns)
@@ -0,0 +1,75 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from eventlist.data import EVENT_DTYPE, EVENTLIST_COLUMNS, create_eventlist
+from eventlist.model import RunEvents, connect_processing_db, processing_db
+from eventlist.packed import pack_run, unpack_run, decode_column, insert_packed_runs
+
+
+def run_eventlist(night, runId, numEvents, seed=0):
+    rng = np.random.RandomState(seed)
+    eventNr = rng.permutation(np.arange(1, numEvents + 1) * 3)
+    utc = np.column_stack([1483300000 + eventNr // 80, rng.randint(0, 1000000, numEvents)])
+    eventType = rng.choice([4, 1024, 33792, 1], size=numEvents)
+    return create_eventlist(night, runId, 'data', eventNr, utc, eventType)
+
+
+def sorted_events(df):
+    events = np.empty(len(df), dtype=EVENT_DTYPE)
+    for name in EVENTLIST_COLUMNS:
+        events[name] = df[name].values
+    return np.sort(events, order='eventNr')
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    connect_processing_db({'backend': 'sqlite', 'database': str(tmp_path / 'eventlist.sqlite')})
+    yield processing_db
+    processing_db.close()
+
+
+def test_pack_run_round_trip():
+    df = run_eventlist(20170101, 12, 500)
+    events = unpack_run(pack_run(20170101, 12, df))
+    assert events.dtype == EVENT_DTYPE
+    np.testing.assert_array_equal(events, sorted_events(df))
+    assert 33792 in events['eventType']
+
+
+def test_pack_empty_run():
+    df = run_eventlist(20170101, 3, 0)
+    row = pack_run(20170101, 3, df)
+    assert row['numEvents'] == 0
+    events = unpack_run(row)
+    assert len(events) == 0
+    assert events.dtype == EVENT_DTYPE
+
+
+def test_packed_format():
+    # the blobs are stored in the database, so the encoding must not change:
+    # zlib compressed little endian arrays, eventNr and UTC as differences to the previous event
+    eventNr = zlib.compress(np.array([5, 1, 1], dtype='<i8').tobytes())
+    np.testing.assert_array_equal(decode_column(eventNr, '<i8', True), [5, 6, 7])
+
+    df = create_eventlist(20170101, 1, 'data', np.array([7, 5, 6]), np.array([[10, 3], [10, 1], [10, 2]]), np.array([33792, 4, 1024]))
+    row = pack_run(20170101, 1, df)
+    assert zlib.decompress(row['eventNr']) == np.array([5, 1, 1], dtype='<i8').tobytes()
+    assert zlib.decompress(row['UTC']) == np.array([10, 0, 0], dtype='<i8').tobytes()
+    assert zlib.decompress(row['UTCus']) == np.array([1, 2, 3], dtype='<u4').tobytes()
+    assert zlib.decompress(row['eventType']) == np.array([4, 1024, 33792], dtype='<u2').tobytes()
+
+
+def test_insert_packed_runs(sqlite_db):
+    runs = [(20170101, 1, 300), (20170101, 2, 1000), (20170102, 1, 50)]
+    dfs = {(night, runId): run_eventlist(night, runId, numEvents, seed=runId) for night, runId, numEvents in runs}
+    # the runs of one dataframe, interleaved, end up in several statements
+    df = pd.concat(dfs.values()).sample(frac=1, random_state=0)
+    insert_packed_runs(df, batch_size=2, max_bytes=1)
+
+    rows = list(RunEvents.select().order_by(RunEvents.night, RunEvents.runId))
+    assert [(row.night, row.runId, row.numEvents) for row in rows] == runs
+    for row in rows:
+        np.testing.assert_array_equal(unpack_run(row), sorted_events(dfs[(row.night, row.runId)]))
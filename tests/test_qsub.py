@@ -0,0 +1,51 @@
+import pytest
+import yaml
+
+from eventlist.qsub import scale_walltime, scale_memory, array_task_resources
+
+
+@pytest.mark.parametrize('walltime, factor, expected', [
+    ('00:20:00', 3, '01:00:00'),
+    ('1:30:30', 2, '03:01:00'),
+    ('45:00', 2, '01:30:00'),
+    (1200, 3, '01:00:00'),
+    ('600', 2, '00:20:00'),
+    ('12:00:00', 3, '36:00:00'),
+])
+def test_scale_walltime(walltime, factor, expected):
+    assert scale_walltime(walltime, factor) == expected
+
+
+def test_scale_walltime_from_yaml():
+    # yaml 1.1 reads unquoted times from 10 hours on as integer seconds
+    walltime = yaml.safe_load('walltime: 12:00:00')['walltime']
+    assert walltime == 43200
+    assert scale_walltime(walltime, 2) == '24:00:00'
+
+
+def test_scale_walltime_unparsable():
+    assert scale_walltime('1 day', 2) == '1 day'
+
+
+@pytest.mark.parametrize('memory, factor, expected', [
+    ('1gb', 4, '4gb'),
+    ('2G', 3, '6G'),
+    ('1.5gb', 2, '3gb'),
+    ('1.5gb', 3, '4608mb'),
+    ('0.5GB', 1, '512MB'),
+    (2048, 2, '4096'),
+])
+def test_scale_memory(memory, factor, expected):
+    assert scale_memory(memory, factor) == expected
+
+
+def test_scale_memory_unparsable():
+    assert scale_memory('lots', 2) == 'lots'
+
+
+def test_array_task_resources():
+    res = {'walltime': 43200, 'vmem': '1.5gb', 'pmem': '1.5gb'}
+    taskRes, workers = array_task_resources(res, files_per_task=10, jobs_per_task=4)
+    assert workers == 4
+    assert taskRes == {'walltime': '36:00:00', 'vmem': '6gb', 'pmem': '1.5gb'}
+    assert res['walltime'] == 43200
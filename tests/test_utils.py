@@ -0,0 +1,12 @@
+import os
+
+from eventlist.utils import load_json_state, save_json_state
+
+
+def test_json_state_round_trip(tmp_path):
+    path = str(tmp_path / 'new_directory' / 'state.json')
+    assert load_json_state(path, {}) == {}
+
+    save_json_state(path, {'since': '2017-01-01', 'runs': [[20170101, 1]]})
+    assert load_json_state(path) == {'since': '2017-01-01', 'runs': [[20170101, 1]]}
+    assert os.listdir(os.path.dirname(path)) == ['state.json']
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from eventlist.data import read_zfits_columns, processZFitsFile
+
+COLUMNS = ['EventNum', 'UnixTimeUTC', 'TriggerType']
+
+
+def test_read_zfits_columns(zfits_run):
+    path, expected = zfits_run
+    header, data = read_zfits_columns(path, COLUMNS)
+
+    assert header['ZNAXIS2'] == len(expected['EventNum'])
+    np.testing.assert_array_equal(data['EventNum'], expected['EventNum'][:, 0])
+    np.testing.assert_array_equal(data['UnixTimeUTC'], expected['UnixTimeUTC'])
+    np.testing.assert_array_equal(data['TriggerType'], expected['TriggerType'][:, 0])
+
+
+def test_read_zfits_columns_compressed(compressed_zfits_run):
+    path, expected = compressed_zfits_run
+    header, data = read_zfits_columns(path, COLUMNS)
+    np.testing.assert_array_equal(data['EventNum'], expected['EventNum'][:, 0])
+
+    with pytest.raises(ValueError):
+        read_zfits_columns(path, ['Data'])
+
+
+def test_columns_only_matches_factfits(zfits_run):
+    path, expected = zfits_run
+    columns = processZFitsFile(path, columns_only=True)
+    factfits = processZFitsFile(path, columns_only=False)
+
+    assert list(columns.columns) == list(factfits.columns)
+    assert (columns.dtypes == factfits.dtypes).all()
+    np.testing.assert_array_equal(columns.values, factfits.values)